@@ -1,27 +1,153 @@
 import os
 import json
-from flask import Flask, render_template, session, redirect, request, url_for, jsonify, send_from_directory, Response, stream_with_context
-from flask_cors import CORS
+from flask import Flask, render_template, session, redirect, request, url_for, jsonify, send_from_directory, Response, stream_with_context, g
+from flask import before_render_template, template_rendered
 import spotipy
+from spotipy.exceptions import SpotifyException
 from spotipy.oauth2 import SpotifyOAuth
+from spotipy.cache_handler import CacheHandler
+import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 import time
+import random
+import base64
+import re
+import bisect
+import unicodedata
+from array import array
+from itertools import islice, accumulate
+import gzip
+import zlib
+import hashlib
+import heapq
+import mmap
+import struct
+import glob
+import logging
+from datetime import datetime, timezone
 from werkzeug.exceptions import HTTPException
-import sys
+from werkzeug.utils import secure_filename
+import threading
+import asyncio
+import uuid
+import sqlite3
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import httpx
+except ImportError:
+    httpx = None
 
 load_dotenv()
 
+# Leveled logging; LOG_LEVEL=DEBUG shows per-request detail
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+                    format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger('yocrify')
+
+# In-process metrics, served in the Prometheus text format at /metrics. Each
+# worker process keeps its own, so scrape the workers individually.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Metric:
+    """A counter or histogram with labels; updating it is a dict lookup under a lock"""
+
+    def __init__(self, name, description, kind, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.kind = kind
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}  # label values -> count, or [per-bucket counts..., +Inf count, sum]
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                counts = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def render(self):
+        def labels(values, extra=()):
+            pairs = list(zip(self.labels, values)) + list(extra)
+            if not pairs:
+                return ''
+            escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+            return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            values = {key: list(value) if self.kind == 'histogram' else value for key, value in self.values.items()}
+        for key, value in sorted(values.items()):
+            if self.kind == 'counter':
+                lines.append(f'{self.name}{labels(key)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), value):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{labels(key, [("le", bound)])} {cumulative}')
+            lines.append(f'{self.name}_sum{labels(key)} {value[-1]}')
+            lines.append(f'{self.name}_count{labels(key)} {cumulative}')
+        return lines
+
+METRICS = []
+
+def counter(name, description, labels=()):
+    METRICS.append(Metric(name, description, 'counter', labels))
+    return METRICS[-1]
+
+def histogram(name, description, labels=(), buckets=DEFAULT_BUCKETS):
+    METRICS.append(Metric(name, description, 'histogram', labels, buckets))
+    return METRICS[-1]
+
+def render_metrics():
+    return '\n'.join(line for metric in METRICS for line in metric.render()) + '\n'
+
+http_request_seconds = histogram('yocrify_http_request_seconds', 'Time to produce a response (streamed bodies excluded)',
+                                 ('endpoint', 'method', 'status'))
+template_render_seconds = histogram('yocrify_template_render_seconds', 'Jinja template rendering time', ('template',))
+spotify_requests_total = counter('yocrify_spotify_requests_total', 'Spotify Web API requests by outcome',
+                                 ('endpoint', 'status'))
+spotify_request_seconds = histogram('yocrify_spotify_request_seconds', 'Spotify Web API request latency', ('endpoint',))
+spotify_retries_total = counter('yocrify_spotify_retries_total', 'Retried Spotify requests by cause', ('reason',))
+spotify_rate_limit_wait_seconds_total = counter('yocrify_spotify_rate_limit_wait_seconds_total',
+                                                'Retry-After time the rate limiter was paused for after 429s')
+json_load_seconds = histogram('yocrify_json_load_seconds', 'Time to read and parse stored JSON', ('file',))
+json_dump_seconds = histogram('yocrify_json_dump_seconds', 'Time to serialize and write stored JSON', ('file',))
+sync_jobs_total = counter('yocrify_sync_jobs_total', 'Finished library syncs', ('engine', 'outcome'))
+sync_seconds = histogram('yocrify_sync_seconds', 'Library sync duration', ('engine',),
+                         buckets=(1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800))
+
 app = Flask(__name__)
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'your-secret-key-here')  # Use consistent secret key
-CORS(app)  # Enable CORS for all routes
 
 # Error handling middleware
 @app.errorhandler(Exception)
 def handle_error(error):
-    print(f"\n=== Error Handler ===")
-    print(f"Error type: {type(error)}")
-    print(f"Error message: {str(error)}")
-    
     response = {
         'success': False,
         'error': 'An unexpected error occurred. Please try again.'
@@ -32,12 +158,15 @@ def handle_error(error):
         status_code = error.code
     else:
         status_code = 500
-        
-    print(f"Returning error response: {response}")
+
+    if status_code >= 500:
+        logger.error("Unhandled %s: %s", type(error).__name__, error, exc_info=error)
+    else:
+        logger.debug("HTTP %s on %s: %s", status_code, request.path, error)
     return jsonify(response), status_code
 
 # Ensure data directory exists
-DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'user_data')
+DATA_DIR = os.getenv('DATA_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'user_data'))
 try:
     os.makedirs(DATA_DIR, exist_ok=True)
     # Test write permissions
@@ -45,9 +174,9 @@ try:
     with open(test_file, 'w') as f:
         f.write('test')
     os.remove(test_file)
-    print("Data directory is writable:", DATA_DIR)
+    logger.debug("Data directory is writable: %s", DATA_DIR)
 except Exception as e:
-    print(f"Error setting up data directory: {str(e)}")
+    logger.error("Error setting up data directory: %s", e)
 
 # Spotify OAuth Configuration
 SPOTIFY_CLIENT_ID = os.getenv('SPOTIFY_CLIENT_ID')
@@ -55,117 +184,1991 @@ SPOTIFY_CLIENT_SECRET = os.getenv('SPOTIFY_CLIENT_SECRET')
 SPOTIFY_REDIRECT_URI = os.getenv('SPOTIFY_REDIRECT_URI')
 SCOPE = 'user-library-read playlist-read-private playlist-read-collaborative'
 
-# Page size configuration
-PLAYLIST_PAGE_SIZE = int(os.getenv('PLAYLIST_PAGE_SIZE', '20'))
+# Page size configuration
+PLAYLIST_PAGE_SIZE = int(os.getenv('PLAYLIST_PAGE_SIZE', '20'))
+TRACK_PAGE_SIZE = int(os.getenv('TRACK_PAGE_SIZE', '100'))
+MAX_PAGE_SIZE = 500
+
+# HTTP caching and compression configuration
+STATIC_MAX_AGE = 365 * 24 * 3600  # Static URLs carry a version, so they can be cached for good
+COMPRESS_MIN_BYTES = 1024
+# Only generated responses: static files are streamed from disk as passthrough
+# responses and left uncompressed here, like any other file send_file serves
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson', 'text/html'}
+
+# Sync concurrency configuration
+SYNC_MAX_WORKERS = max(1, int(os.getenv('SYNC_MAX_WORKERS', '8')))
+# 'threads' runs each sync on a thread pool with spotipy; 'asyncio' runs all
+# syncs of the process on one event loop with httpx (optional dependency)
+SYNC_ENGINE = os.getenv('SYNC_ENGINE', 'threads').lower()
+if SYNC_ENGINE == 'asyncio' and httpx is None:
+    logger.warning("SYNC_ENGINE=asyncio needs the httpx package; falling back to threads")
+    SYNC_ENGINE = 'threads'
+# Base URL of the Web API; pointed at a local stand-in by the benchmarks
+SPOTIFY_API_PREFIX = os.getenv('SPOTIFY_API_PREFIX', 'https://api.spotify.com/v1/')
+TRACKS_PAGE_LIMIT = 100  # Maximum page size accepted by the playlist tracks endpoint
+
+# Fields of Spotify objects that the UI renders. A value of None keeps the
+# field as-is, a dict selects fields of a nested object and a one-element
+# list selects fields of every object in a nested array. The same schema
+# builds the `fields=` filter sent to Spotify and trims records before
+# they are persisted.
+TRACK_FIELDS = {
+    'id': None,
+    'uri': None,
+    'name': None,
+    'duration_ms': None,
+    'artists': [{'id': None, 'name': None}],
+    'album': {'id': None, 'name': None, 'release_date': None},
+}
+TRACKS_PAGE_FIELDS = {
+    'items': [{'track': TRACK_FIELDS}],
+    'next': None,
+    'total': None,
+}
+PLAYLIST_FIELDS = {
+    'id': None,
+    'snapshot_id': None,
+    'name': None,
+    'description': None,
+    'images': [{'url': None}],
+    'owner': {'display_name': None, 'external_urls': None, 'href': None, 'id': None, 'type': None, 'uri': None},
+    'tracks': TRACKS_PAGE_FIELDS,
+}
+
+def schema_to_fields(schema):
+    """Build a Spotify Web API `fields` filter from a field schema"""
+    parts = []
+    for name, sub_schema in schema.items():
+        if isinstance(sub_schema, list):
+            sub_schema = sub_schema[0]
+        parts.append(f"{name}({schema_to_fields(sub_schema)})" if sub_schema else name)
+    return ','.join(parts)
+
+def project(record, schema):
+    """Return a copy of record containing only the fields listed in schema"""
+    if record is None:
+        return None
+    projected = {}
+    for name, sub_schema in schema.items():
+        if name not in record:
+            continue
+        value = record[name]
+        if isinstance(sub_schema, list) and isinstance(value, list):
+            value = [project(element, sub_schema[0]) for element in value]
+        elif isinstance(sub_schema, dict):
+            value = project(value, sub_schema)
+        projected[name] = value
+    return projected
+
+PLAYLIST_API_FIELDS = schema_to_fields(PLAYLIST_FIELDS)
+TRACKS_PAGE_API_FIELDS = schema_to_fields(TRACKS_PAGE_FIELDS)
+
+# Storage backend configuration: 'json' (one file per user) or 'sqlite'
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json').lower()
+SQLITE_PATH = os.getenv('SQLITE_PATH', os.path.join(DATA_DIR, 'library.db'))
+
+# Cross-process coordination database: sync leases and the events of running syncs
+COORDINATION_DB_PATH = os.getenv('COORDINATION_DB_PATH', os.path.join(DATA_DIR, 'coordination.db'))
+
+# Parsed library cache configuration (budget is the estimated memory of the cached libraries, see cached_library)
+LIBRARY_CACHE_MAX_BYTES = int(os.getenv('LIBRARY_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+
+# Spotify HTTP configuration
+SPOTIFY_REQUEST_TIMEOUT = float(os.getenv('SPOTIFY_REQUEST_TIMEOUT', '20'))
+SPOTIFY_RATE_LIMIT = float(os.getenv('SPOTIFY_RATE_LIMIT', '10'))  # Requests per second, 0 disables
+SPOTIFY_RATE_BURST = int(os.getenv('SPOTIFY_RATE_BURST', '20'))
+SPOTIFY_MAX_ATTEMPTS = int(os.getenv('SPOTIFY_MAX_ATTEMPTS', '5'))
+SPOTIFY_BACKOFF_BASE = 0.5  # Seconds, doubled on every retry
+SPOTIFY_BACKOFF_CAP = 30  # Longest wait before a retry; a longer Retry-After is raised instead
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class RateLimiter:
+    """Token bucket shared by every Spotify request made by this process.
+
+    A 429 response pauses the whole bucket for its Retry-After interval, so
+    concurrent sync workers back off together instead of each hitting the
+    limit again.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        """Take a token if one is available; returns 0, or the time to wait before trying again"""
+        if self.rate <= 0:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait_time = self.blocked_until - now
+            if wait_time <= 0:
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return 0
+                wait_time = (1 - self.tokens) / self.rate
+            return wait_time
+
+    def acquire(self):
+        while (wait_time := self.try_acquire()) > 0:
+            time.sleep(wait_time)
+
+    async def acquire_async(self):
+        while (wait_time := self.try_acquire()) > 0:
+            await asyncio.sleep(wait_time)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+spotify_rate_limiter = RateLimiter(SPOTIFY_RATE_LIMIT, SPOTIFY_RATE_BURST)
+
+def create_http_session():
+    """Create the pooled HTTP session shared by all Spotify clients of this process"""
+    http_session = requests.Session()
+    # Retries are handled by fetch_with_retry, not by urllib3
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(10, SYNC_MAX_WORKERS * 2), max_retries=0)
+    http_session.mount('https://', adapter)
+    http_session.mount('http://', adapter)
+    return http_session
+
+spotify_http_session = create_http_session()
+
+SPOTIFY_ID_COLLECTIONS = {'playlists', 'users', 'tracks', 'albums', 'artists'}
+
+def spotify_endpoint(url):
+    """Return the API path of a request URL with ids replaced, e.g. playlists/{id}/tracks"""
+    segments = url.split('?', 1)[0].split('/v1/', 1)[-1].strip('/').split('/')
+    return '/'.join('{id}' if i and segments[i - 1] in SPOTIFY_ID_COLLECTIONS else segment
+                    for i, segment in enumerate(segments))
+
+class RateLimitedSpotify(spotipy.Spotify):
+    """Spotify client that goes through the shared rate limiter and retry policy"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prefix = SPOTIFY_API_PREFIX
+
+    def _internal_call(self, method, url, payload, params):
+        return fetch_with_retry(self._rate_limited_call, method, url, payload, params)
+
+    def _rate_limited_call(self, method, url, payload, params):
+        spotify_rate_limiter.acquire()
+        endpoint = spotify_endpoint(url)
+        status = 'error'
+        started = time.perf_counter()
+        try:
+            result = super()._internal_call(method, url, payload, dict(params))
+            status = '200'
+            return result
+        except SpotifyException as e:
+            status = str(e.http_status)
+            raise
+        finally:
+            spotify_request_seconds.observe(time.perf_counter() - started, endpoint)
+            spotify_requests_total.inc(endpoint, status)
+
+    def __del__(self):
+        # The pooled session outlives individual clients; don't close it
+        pass
+
+# Token management. Each user's token lives in its own file under
+# TOKEN_DIR and the session only carries the user id. Tokens are refreshed
+# in the background once they are within TOKEN_PROACTIVE_REFRESH_SECONDS of
+# expiring, and inline only when a request finds one about to expire.
+# Refreshes of one user are serialized by a per-user lock (and a lock file
+# across processes), and a refresh that finds the stored token already
+# renewed by someone else reuses it, so concurrent refreshes make one call.
+TOKEN_DIR = os.path.join(DATA_DIR, 'tokens')
+TOKEN_REFRESH_MARGIN_SECONDS = 60
+TOKEN_PROACTIVE_REFRESH_SECONDS = 600
+
+class NoTokenCache(CacheHandler):
+    """spotipy cache handler that keeps nothing; the TokenManager stores tokens itself"""
+
+    def get_cached_token(self):
+        return None
+
+    def save_token_to_cache(self, token_info):
+        pass
+
+def create_spotify_oauth():
+    return SpotifyOAuth(
+        client_id=SPOTIFY_CLIENT_ID,
+        client_secret=SPOTIFY_CLIENT_SECRET,
+        redirect_uri=SPOTIFY_REDIRECT_URI,
+        scope=SCOPE,
+        requests_timeout=SPOTIFY_REQUEST_TIMEOUT,
+        cache_handler=NoTokenCache()
+    )
+
+class TokenManager:
+    """Per-user Spotify token store with proactive, single-flight refreshes"""
+
+    def __init__(self, token_dir):
+        self.token_dir = token_dir
+        os.makedirs(token_dir, exist_ok=True)
+        self._oauth = None
+        self.tokens = {}
+        self.user_locks = {}
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    @property
+    def oauth(self):
+        """The SpotifyOAuth shared by every refresh, created on first use"""
+        if self._oauth is None:
+            self._oauth = create_spotify_oauth()
+        return self._oauth
+
+    def token_path(self, user_id):
+        return os.path.join(self.token_dir, f'{secure_filename(user_id)}.json')
+
+    def user_lock(self, user_id):
+        with self.lock:
+            return self.user_locks.setdefault(user_id, threading.Lock())
+
+    def load(self, user_id):
+        try:
+            with open(self.token_path(user_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, user_id, token_info):
+        """Store a user's token, readable by the owner only"""
+        path = self.token_path(user_id)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w', encoding='utf-8') as f:
+            json.dump(token_info, f)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.tokens[user_id] = token_info
+
+    def cached_access_token(self, user_id):
+        """Return the user's access token if it is known and not about to expire, without blocking"""
+        token_info = self.tokens.get(user_id)
+        if token_info and token_info['expires_at'] - time.time() > TOKEN_REFRESH_MARGIN_SECONDS:
+            return token_info['access_token']
+        return None
+
+    def get_access_token(self, user_id):
+        """Return a valid access token for the user, or None if they have to log in again"""
+        token_info = self.tokens.get(user_id) or self.load(user_id)
+        if not token_info:
+            return None
+        remaining = token_info['expires_at'] - time.time()
+        if remaining <= TOKEN_REFRESH_MARGIN_SECONDS:
+            token_info = self.refresh(user_id, token_info)
+        elif remaining <= TOKEN_PROACTIVE_REFRESH_SECONDS:
+            self.refresh_in_background(user_id, token_info)
+        else:
+            with self.lock:
+                self.tokens[user_id] = token_info
+        return token_info['access_token'] if token_info else None
+
+    def refresh_in_background(self, user_id, token_info):
+        with self.lock:
+            if user_id in self.refreshing:
+                return
+            self.refreshing.add(user_id)
+
+        def run():
+            try:
+                self.refresh(user_id, token_info)
+            finally:
+                with self.lock:
+                    self.refreshing.discard(user_id)
+
+        threading.Thread(target=run, name=f'token-refresh-{user_id}', daemon=True).start()
+
+    def refresh(self, user_id, stale_token):
+        """Refresh stale_token once; callers that lost the race get the token the winner stored"""
+        with self.user_lock(user_id), self.file_lock(user_id):
+            current = self.load(user_id) or stale_token
+            if (current['access_token'] != stale_token['access_token']
+                    and current['expires_at'] - time.time() > TOKEN_PROACTIVE_REFRESH_SECONDS):
+                with self.lock:
+                    self.tokens[user_id] = current
+                return current
+            try:
+                token_info = self.oauth.refresh_access_token(current['refresh_token'])
+            except Exception as e:
+                logger.error("Error refreshing token for user %s: %s", user_id, e)
+                # Still usable until it expires
+                return current if current['expires_at'] > time.time() else None
+            self.save(user_id, token_info)
+            logger.info("Token refreshed for user %s", user_id)
+            return token_info
+
+    @contextmanager
+    def file_lock(self, user_id):
+        """Hold an exclusive lock on the user's token lock file, where fcntl is available"""
+        if fcntl is None:
+            yield
+            return
+        with open(f'{self.token_path(user_id)}.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+token_manager = TokenManager(TOKEN_DIR)
+
+class UserAuthManager:
+    """spotipy auth manager that asks the TokenManager for the user's current token on every request"""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+
+    def get_access_token(self, as_dict=False):
+        token = token_manager.get_access_token(self.user_id)
+        if token is None:
+            raise SpotifyException(401, -1, 'The access token expired and could not be refreshed')
+        return token
+
+    def cached_access_token(self):
+        return token_manager.cached_access_token(self.user_id)
+
+def get_spotify():
+    """Get an authenticated Spotify client for the session user, or None"""
+    try:
+        user_id = session.get('user_id')
+        # Sessions from before the token store carry the token itself
+        legacy_token = session.pop('token_info', None)
+        if legacy_token:
+            try:
+                legacy_token = token_manager.oauth.validate_token(legacy_token)
+                if legacy_token:
+                    user_id = RateLimitedSpotify(auth=legacy_token['access_token'], requests_session=spotify_http_session,
+                                                 requests_timeout=SPOTIFY_REQUEST_TIMEOUT).current_user()['id']
+                    token_manager.save(user_id, legacy_token)
+                    session['user_id'] = user_id
+            except Exception as e:
+                logger.error("Error migrating session token: %s", e)
+        if not user_id or not token_manager.get_access_token(user_id):
+            logger.debug("No valid token for the session")
+            return None
+                
+        # Create client on the shared, rate-limited connection pool
+        sp = RateLimitedSpotify(
+            auth_manager=UserAuthManager(user_id),
+            requests_session=spotify_http_session,
+            requests_timeout=SPOTIFY_REQUEST_TIMEOUT
+        )
+        return sp
+        
+    except Exception as e:
+        logger.error("Error in get_spotify: %s", e)
+        return None
+
+def is_retryable_error(error):
+    """Return True for rate limits, server errors and network failures"""
+    if isinstance(error, SpotifyException):
+        return error.http_status in RETRYABLE_STATUS_CODES
+    if httpx is not None and isinstance(error, httpx.TransportError):
+        return True
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+def get_retry_after(error):
+    """Return the Retry-After delay in seconds of a 429 response, if any"""
+    if isinstance(error, SpotifyException) and error.http_status == 429:
+        try:
+            return max(0, int((error.headers or {}).get('Retry-After', 1)))
+        except (TypeError, ValueError):
+            return 1
+    return None
+
+def fetch_with_retry(func, *args, max_retries=SPOTIFY_MAX_ATTEMPTS, **kwargs):
+    """Call func, retrying retryable errors up to max_retries attempts in total.
+
+    Rate limits wait for the Retry-After interval (pausing the shared rate
+    limiter); other retryable errors use exponential backoff with full jitter.
+    """
+    for attempt in range(max_retries):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            delay = retry_delay(e, attempt, max_retries)
+            if delay is None:
+                raise
+            time.sleep(delay)
+
+def retry_delay(error, attempt, max_retries):
+    """Return how long to wait before retrying after error, or None if it must be raised.
+
+    A 429 pauses the shared rate limiter for its Retry-After interval. One
+    asking for more than SPOTIFY_BACKOFF_CAP seconds is raised right away
+    instead, so no request ever waits on the limiter for longer than that.
+    """
+    if attempt == max_retries - 1 or not is_retryable_error(error):
+        return None
+    retry_after = get_retry_after(error)
+    if retry_after is not None:
+        if retry_after > SPOTIFY_BACKOFF_CAP:
+            logger.warning("Not retrying a rate limit with Retry-After %ss", retry_after)
+            return None
+        spotify_rate_limiter.pause(retry_after)
+        spotify_rate_limit_wait_seconds_total.inc(amount=retry_after)
+        delay = retry_after
+    else:
+        delay = random.uniform(0, min(SPOTIFY_BACKOFF_CAP, SPOTIFY_BACKOFF_BASE * 2 ** attempt))
+    spotify_retries_total.inc(str(error.http_status) if isinstance(error, SpotifyException) else type(error).__name__)
+    logger.warning("Retrying after %s in %.1fs (attempt %s/%s)", type(error).__name__, delay, attempt + 1, max_retries)
+    return delay
+
+def get_all_items(sp, initial_request, get_next):
+    items = []
+    results = initial_request
+    
+    while results:
+        items.extend(results['items'])
+        if not results['next']:
+            break
+        try:
+            results = get_next(results)
+        except Exception as e:
+            break
+    
+    return items
+
+def fetch_playlists_concurrently(sp, items, executor):
+    """Fetch playlists and all of their track pages on a shared worker pool.
+
+    Yields (item, full_playlist, tracks, error) tuples in completion order. The
+    first tracks page comes with the playlist itself; the remaining pages are
+    requested in parallel once the total is known.
+    """
+    pending = {}
+    state = {}
+    for item in items:
+        state[item['id']] = {'item': item, 'playlist': None, 'pages': {}, 'remaining': 0, 'failed': False}
+        pending[executor.submit(sp.playlist, item['id'], fields=PLAYLIST_API_FIELDS)] = (item['id'], None)
+
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            playlist_id, offset = pending.pop(future)
+            entry = state[playlist_id]
+            if entry['failed']:
+                continue
+            try:
+                result = future.result()
+            except Exception as e:
+                entry['failed'] = True
+                yield entry['item'], None, None, e
+                continue
+
+            if offset is None:
+                # Playlist request: carries the first page of tracks
+                entry['playlist'] = result
+                first_page = result['tracks']
+                entry['pages'][0] = first_page['items']
+                for page_offset in range(len(first_page['items']), first_page['total'], TRACKS_PAGE_LIMIT):
+                    page_future = executor.submit(sp.playlist_tracks, playlist_id,
+                                                  fields=TRACKS_PAGE_API_FIELDS, limit=TRACKS_PAGE_LIMIT,
+                                                  offset=page_offset)
+                    pending[page_future] = (playlist_id, page_offset)
+                    entry['remaining'] += 1
+            else:
+                entry['pages'][offset] = result['items']
+                entry['remaining'] -= 1
+
+            if entry['remaining'] == 0:
+                tracks = [track_item['track']
+                          for page_offset in sorted(entry['pages'])
+                          for track_item in entry['pages'][page_offset]
+                          if track_item['track']]
+                yield entry['item'], entry['playlist'], tracks, None
+
+# Asyncio Spotify client used by the 'asyncio' sync engine. It covers the
+# endpoints a sync needs, returns the same JSON as spotipy and shares the
+# process-wide rate limiter and retry policy; a semaphore bounds the requests
+# one sync has in flight.
+_async_http_clients = {}
+
+def get_async_http_client():
+    """Return the pooled httpx client of the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _async_http_clients.get(loop)
+    if client is None:
+        client = _async_http_clients[loop] = httpx.AsyncClient(
+            timeout=SPOTIFY_REQUEST_TIMEOUT,
+            limits=httpx.Limits(max_connections=max(10, SYNC_MAX_WORKERS * 4)))
+    return client
+
+async def close_async_http_client():
+    """Close the httpx client of the running event loop, if it has one"""
+    client = _async_http_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+class AsyncSpotify:
+    """Minimal asyncio counterpart of RateLimitedSpotify for the sync endpoints"""
+
+    def __init__(self, auth_manager, concurrency=SYNC_MAX_WORKERS):
+        self.auth_manager = auth_manager
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    async def access_token(self):
+        # A refresh blocks, so it runs off the event loop
+        return (self.auth_manager.cached_access_token()
+                or await asyncio.to_thread(self.auth_manager.get_access_token))
+
+    async def _get(self, url, params=None):
+        if not url.startswith('http'):
+            url = SPOTIFY_API_PREFIX + url
+        endpoint = spotify_endpoint(url)
+        for attempt in range(SPOTIFY_MAX_ATTEMPTS):
+            try:
+                headers = {'Authorization': f'Bearer {await self.access_token()}'}
+                async with self.semaphore:
+                    await spotify_rate_limiter.acquire_async()
+                    status = 'error'
+                    started = time.perf_counter()
+                    try:
+                        response = await get_async_http_client().get(url, params=params, headers=headers)
+                        status = str(response.status_code)
+                    finally:
+                        spotify_request_seconds.observe(time.perf_counter() - started, endpoint)
+                        spotify_requests_total.inc(endpoint, status)
+                if response.status_code >= 400:
+                    raise SpotifyException(response.status_code, -1, f'{url}: {response.text}',
+                                           headers=response.headers)
+                return response.json()
+            except Exception as e:
+                delay = retry_delay(e, attempt, SPOTIFY_MAX_ATTEMPTS)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+
+    async def current_user_playlists(self, limit=50, offset=0):
+        return await self._get('me/playlists', {'limit': limit, 'offset': offset})
+
+    async def playlist(self, playlist_id, fields=None):
+        return await self._get(f'playlists/{playlist_id}', {'fields': fields, 'additional_types': 'track'})
+
+    async def playlist_tracks(self, playlist_id, fields=None, limit=100, offset=0):
+        return await self._get(f'playlists/{playlist_id}/tracks',
+                               {'fields': fields, 'limit': limit, 'offset': offset, 'additional_types': 'track'})
+
+    async def next(self, result):
+        return await self._get(result['next']) if result['next'] else None
+
+async def fetch_playlists_async(sp, items):
+    """Asyncio counterpart of fetch_playlists_concurrently, yielding the same tuples"""
+    async def fetch(item):
+        try:
+            playlist = await sp.playlist(item['id'], fields=PLAYLIST_API_FIELDS)
+            first_page = playlist['tracks']
+            pages = [first_page['items']]
+            pages.extend(page['items'] for page in await asyncio.gather(*(
+                sp.playlist_tracks(item['id'], fields=TRACKS_PAGE_API_FIELDS, limit=TRACKS_PAGE_LIMIT, offset=offset)
+                for offset in range(len(first_page['items']), first_page['total'], TRACKS_PAGE_LIMIT))))
+            return item, playlist, [track_item['track'] for page in pages for track_item in page if track_item['track']], None
+        except Exception as e:
+            return item, None, None, e
+
+    for completed in asyncio.as_completed([fetch(item) for item in items]):
+        yield await completed
+
+# Add data storage functions
+def user_data_path(user_id):
+    """Return the path of a user's library snapshot, converting a legacy JSON library on first use"""
+    file_path = os.path.join(DATA_DIR, f'{secure_filename(user_id)}.snap')
+    if not os.path.exists(file_path):
+        convert_legacy_library(legacy_data_path(user_id), file_path)
+    return file_path
+
+def legacy_data_path(user_id):
+    """Return the path of a library stored as one JSON document by earlier versions"""
+    return os.path.join(DATA_DIR, f'{secure_filename(user_id)}.json')
+
+def open_library_writer(user_id, baseline):
+    """Return the LibraryBuilder that stores a sync of the user's library as it progresses"""
+    if STORAGE_BACKEND == 'sqlite':
+        return SqliteLibraryWriter(user_id, baseline)
+    file_path = user_data_path(user_id)
+    # The caller holds the user's sync lease, so no other writer is running
+    remove_stale_snapshot_files(file_path)
+    return SnapshotWriter(file_path, sync_checkpoint_path(user_id), baseline)
+
+# Library snapshots: the JSON backend stores each library as a file of
+# zlib-compressed JSON frames, followed by an index of their offsets. Readers
+# memory-map the file and decompress only the frames a request needs:
+# - 'meta': last sync and the playlist summaries
+# - 'tracks/<n>': a chunk of the track table, which holds every track once,
+#   numbered by rows in the order playlists first reference them; chunk n
+#   holds rows from n * TRACK_CHUNK_SIZE on
+# - 'playlist/<id>': the rows of a playlist's tracks
+# - 'membership': the track key of each row and the ordinals of the playlists
+#   holding it, from which other_playlists and overlaps are resolved
+# - 'stats_view', 'stats' and 'search_index'
+# The full library, rebuilt from every frame, is only needed for snapshots
+# written without a search index.
+SNAPSHOT_MAGIC = b'YCRSNAP2'
+SNAPSHOT_HEADER = struct.Struct('<8sQQ')  # Magic, index offset, index length
+SNAPSHOT_COMPRESSION_LEVEL = 6
+SNAPSHOT_CACHE_SIZE = 64  # Memory-mapped snapshots kept open per process
+TRACK_CHUNK_SIZE = 32  # Tracks per track table frame; smaller frames cost disk, larger ones decode more per playlist
+TRACK_CHUNKS_PER_READ = 16  # Decoded track table frames kept while reading a playlist
+
+def encode_frame(value):
+    return zlib.compress(json.dumps(value, separators=(',', ':')).encode('utf-8'), SNAPSHOT_COMPRESSION_LEVEL)
+
+# Library builders accumulate a library one playlist at a time: the track
+# rows (numbered in the order playlists first reference them), the ordinals
+# of the playlists holding each row, the stats counters and the search
+# postings. Subclasses store each playlist as it is added, so a sync keeps no
+# track objects in memory beyond the playlist at hand. Given a SyncBaseline
+# whose stored library has stats, those stats are updated incrementally:
+# playlists reused from the stored library are not counted again, changed
+# ones replace their stored version and unlisted ones are removed in
+# settle_stats().
+class LibraryBuilder:
+    """Accumulate a normalized library's membership, stats and search index playlist by playlist"""
+
+    def __init__(self, baseline=None):
+        self.playlist_ids = []
+        self.playlist_names = []
+        self.playlist_rows = []
+        self.rows = {}  # Track key -> row
+        self.keys = []
+        self.memberships = []  # Row -> ordinals of the playlists holding the track
+        self.track_count = 0
+        self.baseline = baseline
+        if baseline is not None and baseline.stats is not None:
+            self.stats = copy_library_stats(baseline.stats)
+            self.stats_membership = StatsMembership(baseline.stored_holders)
+        else:
+            # Counted from scratch: the added playlists are the counted ones
+            self.stats = empty_library_stats()
+            self.stats_membership = None
+        self.search = SearchIndexBuilder()
+
+    def add_playlist(self, playlist, tracks, stored=False, counted=False):
+        """Add a normalized playlist; tracks maps its track keys to track objects.
+
+        stored marks a playlist reused unchanged from the previous sync, which
+        the destination may already hold; counted marks one the baseline's
+        stats already count.
+        """
+        ordinal = len(self.playlist_ids)
+        playlist_id = playlist['id']
+        fresh = self.stats_membership is None
+        counters = self.stats['counters']
+        rows = array('I')
+        for key in playlist['track_ids']:
+            row = self.rows.get(key)
+            if row is None:
+                # First playlist holding this track
+                row = self.rows[key] = len(self.keys)
+                self.keys.append(key)
+                self.memberships.append(array('I', (ordinal,)))
+                track = tracks.get(key)
+                if fresh:
+                    count_track_stats(self.stats, track or {}, 1)
+                if track is not None:
+                    self.track_count += 1
+                    self.search.add_track(key, track)
+                self.store_track(row, track)
+            else:
+                holders = self.memberships[row]
+                if holders[-1] != ordinal:
+                    if fresh:
+                        for other in holders:
+                            _bump(self.stats['overlap'], _overlap_key(playlist_id, self.playlist_ids[other]), 1)
+                        if len(holders) == 1:
+                            counters['duplicate_tracks'] += 1
+                    holders.append(ordinal)
+            rows.append(row)
+        if fresh:
+            counters['playlists'] += 1
+        elif not counted:
+            if playlist_id in self.baseline.stored_ids:
+                stored_playlist, stored_tracks = self.baseline.load_stored(playlist_id)
+                apply_playlist_stats(self.stats, self.stats_membership, stored_playlist, stored_tracks, -1)
+            apply_playlist_stats(self.stats, self.stats_membership, playlist, tracks, 1)
+        self.search.add_playlist(playlist)
+        self.playlist_ids.append(playlist_id)
+        self.playlist_names.append(playlist_full_name(playlist))
+        self.playlist_rows.append(rows)
+        self.store_playlist(playlist, rows, tracks, stored)
+
+    def settle_stats(self):
+        """Remove the stored playlists that were not added from incrementally updated stats"""
+        if self.stats_membership is None:
+            return
+        added = set(self.playlist_ids)
+        for playlist_id in self.baseline.stored_ids:
+            if playlist_id not in added:
+                stored_playlist, stored_tracks = self.baseline.load_stored(playlist_id)
+                apply_playlist_stats(self.stats, self.stats_membership, stored_playlist, stored_tracks, -1)
+
+    def store_track(self, row, track):
+        """Store the track first referenced at row; track is None for keys without a track object"""
+
+    def store_playlist(self, playlist, rows, tracks, stored):
+        """Store an added playlist"""
+
+    def duplicate_counts(self):
+        """Return each playlist's count of track entries also held by other playlists"""
+        counts = [len(ordinals) for ordinals in self.memberships]
+        return [sum(counts[row] - 1 for row in rows) for rows in self.playlist_rows]
+
+    def track_name(self, row):
+        return None
+
+    def stats_view(self):
+        """Build the /stats response body of the library added so far"""
+        shared_rows = heapq.nlargest(STATS_TOP_N, (row for row, ordinals in enumerate(self.memberships)
+                                                   if len(ordinals) > 1),
+                                     key=lambda row: len(self.memberships[row]))
+        names = dict(zip(self.playlist_ids, self.playlist_names))
+        return stats_view(
+            self.stats,
+            [(self.keys[row], self.track_name(row), len(self.memberships[row])) for row in shared_rows],
+            names.get)
+
+class SnapshotWriter(LibraryBuilder):
+    """Write a snapshot playlist by playlist, then publish it with finish() or drop it with discard().
+
+    With a checkpoint_path, every playlist that was not reused from storage is
+    also appended to that sync checkpoint log, which finish() removes.
+    """
+
+    def __init__(self, file_path, checkpoint_path=None, baseline=None):
+        super().__init__(baseline)
+        self.file_path = file_path
+        self.tmp_path = f'{file_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        self.file = open(self.tmp_path, 'w+b')
+        self.file.write(bytes(SNAPSHOT_HEADER.size))
+        self.frames = {}
+        self.summaries = []
+        self.chunk = []
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_file = None
+        self.finished = False
+
+    def write_frame(self, name, value):
+        self.frames[name] = (self.file.tell(), self.file.write(encode_frame(value)))
+
+    def read_frame(self, name):
+        offset, length = self.frames[name]
+        self.file.seek(offset)
+        value = json.loads(zlib.decompress(self.file.read(length)))
+        self.file.seek(0, os.SEEK_END)
+        return value
+
+    def store_track(self, row, track):
+        self.chunk.append(track)
+        if len(self.chunk) == TRACK_CHUNK_SIZE:
+            self.flush_tracks()
+
+    def flush_tracks(self):
+        if self.chunk:
+            self.write_frame(f'tracks/{(len(self.keys) - 1) // TRACK_CHUNK_SIZE}', self.chunk)
+            self.chunk = []
+
+    def store_playlist(self, playlist, rows, tracks, stored):
+        self.write_frame(f"playlist/{playlist['id']}", {'rows': rows.tolist()})
+        self.summaries.append({k: v for k, v in playlist.items() if k != 'track_ids'})
+        if self.checkpoint_path and not stored:
+            if self.checkpoint_file is None:
+                self.checkpoint_file = open(self.checkpoint_path, 'a', encoding='utf-8')
+            record = {
+                'playlist': playlist,
+                'tracks': {key: tracks[key] for key in playlist['track_ids'] if key in tracks}
+            }
+            with json_dump_seconds.time('checkpoint'):
+                self.checkpoint_file.write(json.dumps(record) + '\n')
+
+    def checkpoint(self):
+        """Make the playlists appended to the checkpoint log so far durable"""
+        if self.checkpoint_file:
+            self.checkpoint_file.flush()
+            os.fsync(self.checkpoint_file.fileno())
+
+    def track_name(self, row):
+        number, offset = divmod(row, TRACK_CHUNK_SIZE)
+        chunk = self.read_frame(f'tracks/{number}') if f'tracks/{number}' in self.frames else self.chunk
+        return (chunk[offset] or {}).get('name')
+
+    def finish(self, last_sync):
+        """Write the remaining frames and the index, then atomically replace the snapshot"""
+        self.settle_stats()
+        self.flush_tracks()
+        for summary, duplicate_tracks in zip(self.summaries, self.duplicate_counts()):
+            summary['duplicate_tracks'] = duplicate_tracks
+        self.write_frame('membership', {
+            'keys': self.keys,
+            'counts': [len(ordinals) for ordinals in self.memberships],
+            'playlists': [ordinal for ordinals in self.memberships for ordinal in ordinals]
+        })
+        self.write_frame('meta', {
+            'last_sync': last_sync,
+            'track_count': self.track_count,
+            'playlists': self.summaries,
+        })
+        self.write_frame('stats_view', self.stats_view())
+        self.write_frame('stats', self.stats)
+        self.write_frame('search_index', self.search.build())
+        index_offset = self.file.tell()
+        index_length = self.file.write(encode_frame(self.frames))
+        self.file.seek(0)
+        self.file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, index_offset, index_length))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.tmp_path, self.file_path)
+        self.finished = True
+        if self.checkpoint_file:
+            self.checkpoint_file.close()
+        if self.checkpoint_path:
+            try:
+                os.remove(self.checkpoint_path)
+            except FileNotFoundError:
+                pass
+
+    def discard(self):
+        """Drop an unfinished snapshot, keeping the checkpoint log for the next sync to resume from"""
+        if self.finished:
+            return
+        self.file.close()
+        if self.checkpoint_file:
+            self.checkpoint_file.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+def remove_stale_snapshot_files(file_path):
+    """Remove the temporary files of snapshot writers killed before finishing or discarding"""
+    for tmp_path in glob.glob(f'{glob.escape(file_path)}.*.tmp'):
+        try:
+            os.remove(tmp_path)
+            logger.info("Removed stale snapshot file %s", tmp_path)
+        except OSError:
+            pass
+
+def write_snapshot(file_path, data):
+    """Write a normalized library as a snapshot; readers see either the old or the new file, never a partial one"""
+    writer = SnapshotWriter(file_path)
+    try:
+        with json_dump_seconds.time('snapshot'):
+            for playlist in data['playlists']:
+                writer.add_playlist(playlist, data['tracks'])
+            writer.finish(data.get('last_sync', 0))
+    except BaseException:
+        writer.discard()
+        raise
+
+def convert_legacy_library(legacy_path, file_path):
+    """Rewrite a library stored as one JSON document as a snapshot, then remove it"""
+    try:
+        with json_load_seconds.time('legacy'), open(legacy_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return
+    write_snapshot(file_path, normalize_library(data))
+    logger.info("Converted %s to a library snapshot", legacy_path)
+    try:
+        os.remove(legacy_path)
+    except FileNotFoundError:
+        pass
+
+class LibrarySnapshot:
+    """A memory-mapped library snapshot whose frames are decompressed on demand"""
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        with open(file_path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.signature = (stat.st_mtime_ns, stat.st_size)
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_offset, index_length = SNAPSHOT_HEADER.unpack_from(self.map)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f'{file_path} is not a library snapshot')
+        self.frames = self.decode(index_offset, index_length)
+        self.cached_frames = {}
+
+    def decode(self, offset, length):
+        with json_load_seconds.time('snapshot'):
+            return json.loads(zlib.decompress(self.map[offset:offset + length]))
+
+    def frame(self, name):
+        """Return a decoded frame, or None if the snapshot has no such frame"""
+        entry = self.frames.get(name)
+        return self.decode(*entry) if entry else None
+
+    def shared_frame(self, name):
+        """Return a decoded frame kept for the snapshot's lifetime; callers must not modify it"""
+        if name not in self.cached_frames:
+            self.cached_frames[name] = self.frame(name)
+        return self.cached_frames[name]
+
+    def meta(self):
+        meta = self.shared_frame('meta')
+        if 'playlist_refs' not in meta:
+            meta['playlists_by_id'] = {p['id']: p for p in meta['playlists']}
+            meta['ordinals'] = {p['id']: ordinal for ordinal, p in enumerate(meta['playlists'])}
+            meta['playlist_refs'] = [{'id': p['id'], 'name': playlist_full_name(p)} for p in meta['playlists']]
+        return meta
+
+    def membership(self):
+        """Return the playlist ordinals of every row as (offsets, ordinals) arrays.
+
+        The ordinals of row r are ordinals[offsets[r]:offsets[r + 1]]. The
+        arrays are kept in the library cache, and the keys are left out.
+        """
+        def load():
+            frame = self.frame('membership')
+            offsets = array('I', (0,))
+            offsets.extend(accumulate(frame['counts']))
+            ordinals = array('I', frame['playlists'])
+            return (offsets, ordinals), (len(offsets) + len(ordinals)) * ordinals.itemsize
+
+        return cached_library((self.file_path, 'membership'), self.signature, load)
+
+    def playlist_rows(self, playlist_id):
+        """Return (summary, ordinal, track rows) of a playlist, or None"""
+        meta = self.meta()
+        summary = meta['playlists_by_id'].get(playlist_id)
+        frame = summary and self.frame(f'playlist/{playlist_id}')
+        if not frame:
+            return None
+        return summary, meta['ordinals'][playlist_id], frame['rows']
+
+    def iter_tracks(self, rows):
+        """Yield (row, track) for the rows holding a track, decoding track table frames as needed"""
+        chunks = OrderedDict()
+        for row in rows:
+            number, offset = divmod(row, TRACK_CHUNK_SIZE)
+            chunk = chunks.get(number)
+            if chunk is None:
+                chunk = chunks[number] = self.frame(f'tracks/{number}')
+                if len(chunks) > TRACK_CHUNKS_PER_READ:
+                    chunks.popitem(last=False)
+            else:
+                chunks.move_to_end(number)
+            if chunk[offset] is not None:
+                yield row, chunk[offset]
+
+    def playlist(self, playlist_id):
+        """Return (summary, iterator of tracks with their other_playlists) of a playlist, or None"""
+        found = self.playlist_rows(playlist_id)
+        if not found:
+            return None
+        summary, own, rows = found
+        refs = self.meta()['playlist_refs']
+        offsets, ordinals = self.membership()
+
+        def resolve():
+            for row, track in self.iter_tracks(rows):
+                track['other_playlists'] = [refs[o] for o in ordinals[offsets[row]:offsets[row + 1]] if o != own]
+                yield track
+
+        return summary, resolve()
+
+    def overlap(self, playlist_id):
+        """Return [{'id', 'name', 'shared_tracks'}] for the playlists sharing tracks with one, or None"""
+        found = self.playlist_rows(playlist_id)
+        if not found:
+            return None
+        _, own, rows = found
+        offsets, ordinals = self.membership()
+        shared = {}
+        for row in set(rows):
+            for ordinal in ordinals[offsets[row]:offsets[row + 1]]:
+                if ordinal != own:
+                    shared[ordinal] = shared.get(ordinal, 0) + 1
+        refs = self.meta()['playlist_refs']
+        ranked = sorted(shared.items(), key=lambda item: (-item[1], item[0]))
+        return [{**refs[ordinal], 'shared_tracks': count} for ordinal, count in ranked]
+
+    def search_index(self):
+        """Return (search index, row of each track key), kept in the library cache"""
+        def load():
+            search_index = self.frame('search_index') or build_search_index(self.library_data())
+            key_rows = {key: row for row, key in enumerate(self.frame('membership')['keys'])}
+            size = sum(self.frames[name][1] for name in ('search_index', 'membership') if name in self.frames)
+            return (search_index, key_rows), size * SNAPSHOT_SIZE_FACTOR
+
+        return cached_library((self.file_path, 'search_index'), self.signature, load)
+
+    def search(self, query, limit):
+        """Return (playlist summaries, tracks with the playlists holding them) best matching query"""
+        search_index, key_rows = self.search_index()
+        playlist_ids, track_keys = search_matches(search_index, query, limit)
+        meta = self.meta()
+        playlists = [meta['playlists_by_id'][p] for p in playlist_ids if p in meta['playlists_by_id']]
+        refs = meta['playlist_refs']
+        offsets, ordinals = self.membership()
+        tracks = []
+        for row, track in self.iter_tracks([key_rows[key] for key in track_keys if key in key_rows]):
+            track['playlists'] = [refs[o] for o in ordinals[offsets[row]:offsets[row + 1]]]
+            tracks.append(track)
+        return playlists, tracks
+
+    def library_data(self):
+        """Rebuild the normalized library from every frame"""
+        meta = self.meta()
+        keys = self.frame('membership')['keys']
+        tracks = {}
+        for number in range(0, len(keys), TRACK_CHUNK_SIZE):
+            chunk = self.frame(f'tracks/{number // TRACK_CHUNK_SIZE}')
+            tracks.update((key, track) for key, track in zip(keys[number:number + TRACK_CHUNK_SIZE], chunk)
+                          if track is not None)
+        playlists = []
+        for summary in meta['playlists']:
+            playlist = {k: v for k, v in summary.items() if k != 'duplicate_tracks'}
+            playlist['track_ids'] = [keys[row] for row in self.frame(f"playlist/{summary['id']}")['rows']]
+            playlists.append(playlist)
+        data = {'playlists': playlists, 'tracks': tracks, 'last_sync': meta['last_sync']}
+        for name in LIBRARY_EXTRAS:
+            if name in self.frames:
+                data[name] = self.frame(name)
+        return data
+
+_snapshot_cache = OrderedDict()
+_snapshot_cache_lock = threading.Lock()
+
+def open_snapshot(file_path):
+    """Return the current LibrarySnapshot of file_path, or None if it does not exist"""
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    with _snapshot_cache_lock:
+        snapshot = _snapshot_cache.get(file_path)
+        if snapshot and snapshot.signature == (stat.st_mtime_ns, stat.st_size):
+            _snapshot_cache.move_to_end(file_path)
+            return snapshot
+    try:
+        snapshot = LibrarySnapshot(file_path)
+    except FileNotFoundError:
+        return None
+    with _snapshot_cache_lock:
+        # A replaced file stays mapped until the last reader drops it
+        _snapshot_cache[file_path] = snapshot
+        _snapshot_cache.move_to_end(file_path)
+        while len(_snapshot_cache) > SNAPSHOT_CACHE_SIZE:
+            _snapshot_cache.popitem(last=False)
+    return snapshot
+
+# Sync checkpoint log: one JSON record per synced playlist, appended as a
+# sync progresses. It is removed once the new snapshot has been written, so
+# a leftover log means the last sync did not finish and can be resumed.
+def sync_checkpoint_path(user_id):
+    """Return the path of a user's sync checkpoint log"""
+    return os.path.join(DATA_DIR, f'{secure_filename(user_id)}.sync.jsonl')
+
+def index_sync_checkpoint(user_id):
+    """Return {playlist_id: (snapshot_id, offset)} of the records in the checkpoint log.
+
+    A truncated tail left by an interrupted write is cut off, so that records
+    appended by the next sync start on a line of their own.
+    """
+    index = {}
+    offset = 0
+    try:
+        with json_load_seconds.time('checkpoint'), open(sync_checkpoint_path(user_id), 'r+b') as f:
+            for line in f:
+                try:
+                    playlist = json.loads(line)['playlist'] if line.endswith(b'\n') else None
+                except ValueError:
+                    playlist = None
+                if playlist is None:
+                    f.truncate(offset)
+                    break
+                index[playlist['id']] = (playlist.get('snapshot_id'), offset)
+                offset += len(line)
+    except FileNotFoundError:
+        pass
+    return index
+
+def read_sync_checkpoint(user_id, offset):
+    """Return the (playlist, tracks) record at offset in the checkpoint log"""
+    with json_load_seconds.time('checkpoint'), open(sync_checkpoint_path(user_id), 'rb') as f:
+        f.seek(offset)
+        record = json.loads(f.readline())
+    return record['playlist'], record['tracks']
+
+def get_user_library(user_id):
+    """Return the full indexed library of a user (see load_library), or None.
+
+    Routes that only need some playlists use the accessors below, which read
+    just those from a snapshot or through the SQLite indexes.
+    """
+    if STORAGE_BACKEND == 'sqlite':
+        version = get_library_version(user_id)
+        if not version:
+            return None
+
+        def load():
+            with json_load_seconds.time('sqlite'):
+                loaded = sqlite_load_library(user_id)
+            if loaded is None:
+                return None
+            data, size = loaded
+            return build_library_index(data), size * SQLITE_SIZE_FACTOR
+
+        return cached_library(('sqlite', user_id), version[0], load)
+    return load_library(user_data_path(user_id))
+
+def get_user_playlist(user_id, playlist_id, lazy=False):
+    """Return (playlist, tracks) for one playlist of a user, or None if it is not stored.
+
+    With lazy=True tracks is an iterator resolving one track at a time.
+    """
+    if STORAGE_BACKEND == 'sqlite':
+        return sqlite_get_playlist(user_id, playlist_id, lazy)
+    snapshot = open_snapshot(user_data_path(user_id))
+    found = snapshot and snapshot.playlist(playlist_id)
+    if not found:
+        return None
+    summary, tracks = found
+    return summary, tracks if lazy else list(tracks)
+
+def get_user_playlists(user_id):
+    """Return (playlist summaries, last_sync) of a user's library, or None if it is not stored"""
+    if STORAGE_BACKEND == 'sqlite':
+        return sqlite_get_playlist_summaries(user_id)
+    snapshot = open_snapshot(user_data_path(user_id))
+    if not snapshot:
+        return None
+    meta = snapshot.meta()
+    return meta['playlists'], meta['last_sync']
+
+def get_user_playlist_overlap(user_id, playlist_id):
+    """Return [{'id', 'name', 'shared_tracks'}] for the playlists sharing tracks with one, or None"""
+    if STORAGE_BACKEND == 'sqlite':
+        return sqlite_get_playlist_overlap(user_id, playlist_id)
+    snapshot = open_snapshot(user_data_path(user_id))
+    return snapshot.overlap(playlist_id) if snapshot else None
+
+def get_user_stats(user_id):
+    """Return (stats view, last_sync) of a user's library, or None if it is not stored"""
+    if STORAGE_BACKEND == 'sqlite':
+        return sqlite_get_stats_view(user_id)
+    snapshot = open_snapshot(user_data_path(user_id))
+    if not snapshot:
+        return None
+    return snapshot.shared_frame('stats_view'), snapshot.meta()['last_sync']
+
+def get_user_search(user_id, query, limit):
+    """Return (playlist summaries, tracks) of a user's library best matching query, up to limit of each.
+
+    Tracks carry the playlists holding them. Returns None if no library is stored.
+    """
+    if STORAGE_BACKEND == 'sqlite':
+        return sqlite_search(user_id, query, limit)
+    snapshot = open_snapshot(user_data_path(user_id))
+    return snapshot.search(query, limit) if snapshot else None
+
+def get_library_version(user_id):
+    """Return (version, last_modified) of a user's stored library, or None if there is none.
+
+    The version changes whenever the stored library does: it is the library
+    file's mtime and size, or the SQLite last_sync and revision.
+    """
+    if STORAGE_BACKEND == 'sqlite':
+        row = get_db().execute('SELECT last_sync, revision FROM libraries WHERE user_id = ?', (user_id,)).fetchone()
+        return (f'{row[0]:x}-{row[1]:x}', row[0]) if row else None
+    try:
+        st = os.stat(user_data_path(user_id))
+    except OSError:
+        return None
+    return f'{st.st_mtime_ns:x}-{st.st_size:x}', int(st.st_mtime)
+
+# Conditional responses for the library endpoints. The strong ETag covers the
+# library version, the full request URL and the negotiated content coding,
+# so a client revalidating an unchanged library gets an empty 304.
+def library_validators(user_id):
+    """Return (etag, last_modified) for a response built from a user's library, or None"""
+    version = get_library_version(user_id)
+    if not version:
+        return None
+    tag = '|'.join((user_id, version[0], request.full_path, negotiate_encoding() or 'identity'))
+    return hashlib.sha1(tag.encode('utf-8')).hexdigest(), datetime.fromtimestamp(version[1], timezone.utc)
+
+def not_modified(validators):
+    """Return a 304 response if the client already has this version, else None"""
+    if not validators:
+        return None
+    etag, last_modified = validators
+    if request.if_none_match:
+        matched = request.if_none_match.contains(etag)
+    else:
+        matched = bool(request.if_modified_since) and request.if_modified_since >= last_modified.replace(microsecond=0)
+    return cacheable(Response(status=304), validators) if matched else None
+
+def cacheable(response, validators):
+    """Let the client keep a response and revalidate it with the validators"""
+    if validators:
+        response.set_etag(validators[0])
+        response.last_modified = validators[1]
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Accept-Encoding')
+        response.vary.add('Cookie')
+    return response
+
+# SQLite storage backend. Track objects are shared by all users in 'tracks';
+# 'playlists' holds each user's playlist summaries and 'playlist_tracks' the
+# ordered membership. A running sync stages the playlists it fetched under
+# sqlite_staging_id(user_id) and swaps them in when it finishes, storing each
+# playlist's duplicate_tracks count so /playlists reads the playlists table
+# alone. Connections
+# are opened per thread in WAL mode so reads are not blocked by a sync
+# writing to the same database.
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS libraries (
+    user_id TEXT PRIMARY KEY,
+    last_sync INTEGER NOT NULL DEFAULT 0,
+    revision INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS playlists (
+    user_id TEXT NOT NULL,
+    playlist_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    snapshot_id TEXT,
+    name TEXT NOT NULL,
+    data TEXT NOT NULL,
+    duplicate_tracks INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, playlist_id)
+);
+CREATE TABLE IF NOT EXISTS tracks (
+    track_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS playlist_tracks (
+    user_id TEXT NOT NULL,
+    playlist_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    track_id TEXT NOT NULL,
+    PRIMARY KEY (user_id, playlist_id, position)
+);
+CREATE INDEX IF NOT EXISTS playlist_tracks_by_track ON playlist_tracks (user_id, track_id);
+CREATE TABLE IF NOT EXISTS library_extras (
+    user_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (user_id, name)
+);
+"""
+
+# Library sections derived at sync time, stored whole in library_extras along
+# with the /stats response body, 'stats_view'
+LIBRARY_EXTRAS = ('search_index', 'stats')
+
+_sqlite_local = threading.local()
+
+def open_sqlite(path, schema):
+    """Open a WAL mode SQLite connection and create schema in it"""
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(schema)
+    return conn
+
+def get_db():
+    """Return this thread's SQLite connection, creating the schema on first use"""
+    conn = getattr(_sqlite_local, 'conn', None)
+    if conn is None:
+        conn = _sqlite_local.conn = open_sqlite(SQLITE_PATH, SQLITE_SCHEMA)
+        migrate_sqlite(conn)
+    return conn
+
+def migrate_sqlite(conn):
+    """Add the columns missing from databases created by earlier versions, then fill them in"""
+    for table, column, definition, backfill in SQLITE_ADDED_COLUMNS:
+        if column in {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}:
+            continue
+        try:
+            with conn:
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+                if backfill:
+                    for (user_id,) in conn.execute('SELECT user_id FROM libraries').fetchall():
+                        backfill(conn, user_id)
+        except sqlite3.OperationalError:
+            pass  # Added by another connection in the meantime
+
+def _sqlite_upsert_playlist(conn, user_id, position, playlist, tracks):
+    summary = {k: v for k, v in playlist.items() if k != 'track_ids'}
+    conn.execute(
+        """INSERT INTO playlists (user_id, playlist_id, position, snapshot_id, name, data)
+           VALUES (?, ?, ?, ?, ?, ?)
+           ON CONFLICT (user_id, playlist_id) DO UPDATE SET
+               position = excluded.position, snapshot_id = excluded.snapshot_id,
+               name = excluded.name, data = excluded.data""",
+        (user_id, playlist['id'], position, playlist.get('snapshot_id'),
+         playlist_full_name(playlist), json.dumps(summary)))
+    conn.execute('DELETE FROM playlist_tracks WHERE user_id = ? AND playlist_id = ?',
+                 (user_id, playlist['id']))
+    conn.executemany(
+        'INSERT INTO playlist_tracks (user_id, playlist_id, position, track_id) VALUES (?, ?, ?, ?)',
+        [(user_id, playlist['id'], i, key) for i, key in enumerate(playlist['track_ids'])])
+    conn.executemany(
+        """INSERT INTO tracks (track_id, data) VALUES (?, ?)
+           ON CONFLICT (track_id) DO UPDATE SET data = excluded.data""",
+        [(key, json.dumps(tracks[key])) for key in set(playlist['track_ids']) if key in tracks])
+
+def _sqlite_count_duplicates(conn, user_id):
+    """Store each playlist's count of track entries also held by other playlists"""
+    conn.execute('UPDATE playlists SET duplicate_tracks = 0 WHERE user_id = ?', (user_id,))
+    conn.execute(
+        """WITH track_counts AS (
+               SELECT track_id, COUNT(DISTINCT playlist_id) AS playlists
+               FROM playlist_tracks WHERE user_id = ? GROUP BY track_id),
+           duplicates AS (
+               SELECT pt.playlist_id, SUM(c.playlists - 1) AS count
+               FROM playlist_tracks pt JOIN track_counts c ON c.track_id = pt.track_id
+               WHERE pt.user_id = ? GROUP BY pt.playlist_id)
+           UPDATE playlists SET duplicate_tracks = duplicates.count FROM duplicates
+           WHERE playlists.user_id = ? AND playlists.playlist_id = duplicates.playlist_id""",
+        (user_id, user_id, user_id))
+
+def _sqlite_set_last_sync(conn, user_id, last_sync):
+    conn.execute(
+        """INSERT INTO libraries (user_id, last_sync) VALUES (?, ?)
+           ON CONFLICT (user_id) DO UPDATE SET last_sync = excluded.last_sync, revision = revision + 1""",
+        (user_id, int(last_sync or 0)))
+
+def _sqlite_set_extra(conn, user_id, name, value):
+    conn.execute(
+        """INSERT INTO library_extras (user_id, name, data) VALUES (?, ?, ?)
+           ON CONFLICT (user_id, name) DO UPDATE SET data = excluded.data""",
+        (user_id, name, json.dumps(value)))
+
+# Columns added after the first version of SQLITE_SCHEMA:
+# (table, column, definition, backfill(conn, user_id) or None)
+SQLITE_ADDED_COLUMNS = (
+    ('libraries', 'revision', 'INTEGER NOT NULL DEFAULT 0', None),
+    ('playlists', 'duplicate_tracks', 'INTEGER NOT NULL DEFAULT 0', _sqlite_count_duplicates),
+)
+
+def sqlite_staging_id(user_id):
+    """Return the user id under which a running sync stages the playlists it fetched"""
+    return f'{user_id}#sync'
+
+class SqliteLibraryWriter(LibraryBuilder):
+    """Store a synced library in SQLite playlist by playlist.
+
+    Fetched playlists are committed one by one under the user's staging id,
+    where readers do not see them and an interrupted sync can resume from
+    them. finish() swaps them into the library in one transaction, along with
+    the playlists reused unchanged, which stay where they are.
+    """
+
+    def __init__(self, user_id, baseline=None):
+        super().__init__(baseline)
+        self.user_id = user_id
+        self.staging_id = sqlite_staging_id(user_id)
+
+    def store_playlist(self, playlist, rows, tracks, stored):
+        if stored:
+            return
+        conn = get_db()
+        with conn:
+            _sqlite_upsert_playlist(conn, self.staging_id, len(self.playlist_ids) - 1, playlist, tracks)
+
+    def checkpoint(self):
+        pass  # Every playlist is committed as it is stored
+
+    def track_name(self, row):
+        found = get_db().execute('SELECT data FROM tracks WHERE track_id = ?', (self.keys[row],)).fetchone()
+        return json.loads(found[0]).get('name') if found else None
+
+    def finish(self, last_sync):
+        """Swap the staged playlists in, drop the ones no longer listed and store the derived sections"""
+        self.settle_stats()
+        conn = get_db()
+        user_id = self.user_id
+        stats_view = self.stats_view()
+        with conn:
+            playlist_ids = json.dumps(self.playlist_ids)
+            staged_ids = json.dumps([playlist_id for (playlist_id,) in conn.execute(
+                'SELECT playlist_id FROM playlists WHERE user_id = ?', (self.staging_id,))])
+            for table in ('playlist_tracks', 'playlists'):
+                conn.execute(f"""DELETE FROM {table} WHERE user_id = ? AND
+                                 (playlist_id NOT IN (SELECT value FROM json_each(?))
+                                  OR playlist_id IN (SELECT value FROM json_each(?)))""",
+                             (user_id, playlist_ids, staged_ids))
+                conn.execute(f"""DELETE FROM {table} WHERE user_id = ? AND
+                                 playlist_id NOT IN (SELECT value FROM json_each(?))""",
+                             (self.staging_id, playlist_ids))
+                conn.execute(f'UPDATE {table} SET user_id = ? WHERE user_id = ?', (user_id, self.staging_id))
+            duplicate_counts = self.duplicate_counts()
+            conn.executemany(
+                'UPDATE playlists SET position = ?, duplicate_tracks = ? WHERE user_id = ? AND playlist_id = ?',
+                [(position, duplicate_counts[position], user_id, playlist_id)
+                 for position, playlist_id in enumerate(self.playlist_ids)])
+            _sqlite_set_extra(conn, user_id, 'search_index', self.search.build())
+            _sqlite_set_extra(conn, user_id, 'stats', self.stats)
+            _sqlite_set_extra(conn, user_id, 'stats_view', stats_view)
+            _sqlite_set_last_sync(conn, user_id, last_sync)
+
+    def discard(self):
+        pass  # Staged playlists stay for the next sync to resume from
+
+def sqlite_load_library(user_id):
+    """Load a user's whole library in the normalized layout; returns (data, bytes of JSON read), or None"""
+    conn = get_db()
+    row = conn.execute('SELECT last_sync FROM libraries WHERE user_id = ?', (user_id,)).fetchone()
+    if row is None:
+        return None
+    size = 0
+    playlists = []
+    playlists_by_id = {}
+    for playlist_id, data in conn.execute(
+            'SELECT playlist_id, data FROM playlists WHERE user_id = ? ORDER BY position', (user_id,)):
+        size += len(data)
+        playlist = json.loads(data)
+        playlist['track_ids'] = []
+        playlists.append(playlist)
+        playlists_by_id[playlist_id] = playlist
+    for playlist_id, track_id in conn.execute(
+            'SELECT playlist_id, track_id FROM playlist_tracks WHERE user_id = ? ORDER BY playlist_id, position',
+            (user_id,)):
+        if playlist_id in playlists_by_id:
+            playlists_by_id[playlist_id]['track_ids'].append(track_id)
+    tracks = {}
+    for track_id, data in conn.execute(
+            """SELECT track_id, data FROM tracks WHERE track_id IN
+               (SELECT track_id FROM playlist_tracks WHERE user_id = ?)""", (user_id,)):
+        size += len(data)
+        tracks[track_id] = json.loads(data)
+    library = {'playlists': playlists, 'tracks': tracks, 'last_sync': row[0]}
+    for name, data in conn.execute('SELECT name, data FROM library_extras WHERE user_id = ? AND name IN (?, ?)',
+                                   (user_id, *LIBRARY_EXTRAS)):
+        size += len(data)
+        library[name] = json.loads(data)
+    return library, size
+
+def sqlite_get_stats_view(user_id):
+    """Return (stats view, last_sync) stored at sync time, building and storing it for older libraries"""
+    conn = get_db()
+    row = conn.execute(
+        """SELECT l.last_sync, e.data FROM libraries l
+           LEFT JOIN library_extras e ON e.user_id = l.user_id AND e.name = 'stats_view'
+           WHERE l.user_id = ?""", (user_id,)).fetchone()
+    if row is None:
+        return None
+    if row[1] is not None:
+        return json.loads(row[1]), row[0]
+    stats_view = build_stats_view(get_user_library(user_id))
+    with conn:
+        _sqlite_set_extra(conn, user_id, 'stats_view', stats_view)
+    return stats_view, row[0]
+
+def sqlite_get_playlist_summaries(user_id):
+    """Return (playlist summaries with their stored duplicate counts, last_sync), or None"""
+    conn = get_db()
+    row = conn.execute('SELECT last_sync FROM libraries WHERE user_id = ?', (user_id,)).fetchone()
+    if row is None:
+        return None
+    summaries = []
+    for data, duplicate_tracks in conn.execute(
+            'SELECT data, duplicate_tracks FROM playlists WHERE user_id = ? ORDER BY position', (user_id,)):
+        summary = json.loads(data)
+        summary['duplicate_tracks'] = duplicate_tracks
+        summaries.append(summary)
+    return summaries, row[0]
+
+def sqlite_get_playlist_overlap(user_id, playlist_id):
+    """Return [{'id', 'name', 'shared_tracks'}] for the playlists sharing tracks with one, or None"""
+    conn = get_db()
+    if conn.execute('SELECT 1 FROM playlists WHERE user_id = ? AND playlist_id = ?',
+                    (user_id, playlist_id)).fetchone() is None:
+        return None
+    return [{'id': other_id, 'name': name, 'shared_tracks': shared} for other_id, name, shared in conn.execute(
+        """SELECT p.playlist_id, p.name, COUNT(DISTINCT pt.track_id) AS shared
+           FROM playlist_tracks pt
+           JOIN playlist_tracks other ON other.user_id = pt.user_id AND other.track_id = pt.track_id
+               AND other.playlist_id != pt.playlist_id
+           JOIN playlists p ON p.user_id = other.user_id AND p.playlist_id = other.playlist_id
+           WHERE pt.user_id = ? AND pt.playlist_id = ?
+           GROUP BY p.playlist_id ORDER BY shared DESC, p.position""", (user_id, playlist_id))]
+
+def sqlite_get_search_index(user_id, version):
+    """Return a user's stored search index, kept in the library cache until the library version changes"""
+    def load():
+        row = get_db().execute("SELECT data FROM library_extras WHERE user_id = ? AND name = 'search_index'",
+                               (user_id,)).fetchone()
+        if row:
+            return json.loads(row[0]), len(row[0]) * SQLITE_SIZE_FACTOR
+        # Libraries synced before the index existed get one on first search
+        library = get_user_library(user_id)
+        if not library:
+            return None
+        search_index = build_search_index(library['data'])
+        return search_index, len(json.dumps(search_index)) * SQLITE_SIZE_FACTOR
+
+    return cached_library(('sqlite', user_id, 'search_index'), version, load)
+
+def sqlite_search(user_id, query, limit):
+    """Return (playlist summaries, tracks) best matching query, reading only the matches by key"""
+    version = get_library_version(user_id)
+    search_index = version and sqlite_get_search_index(user_id, version[0])
+    if not search_index:
+        return None
+    playlist_ids, track_keys = search_matches(search_index, query, limit)
+    conn = get_db()
+    playlists = {}
+    for playlist_id, data, duplicate_tracks in conn.execute(
+            """SELECT playlist_id, data, duplicate_tracks FROM playlists
+               WHERE user_id = ? AND playlist_id IN (SELECT value FROM json_each(?))""",
+            (user_id, json.dumps(playlist_ids))):
+        summary = playlists[playlist_id] = json.loads(data)
+        summary['duplicate_tracks'] = duplicate_tracks
+    holders = {}
+    for track_id, playlist_id, name in conn.execute(
+            """SELECT pt.track_id, p.playlist_id, p.name
+               FROM playlist_tracks pt
+               JOIN playlists p ON p.user_id = pt.user_id AND p.playlist_id = pt.playlist_id
+               WHERE pt.user_id = ? AND pt.track_id IN (SELECT value FROM json_each(?))
+               ORDER BY p.position""", (user_id, json.dumps(track_keys))):
+        holders.setdefault(track_id, {}).setdefault(playlist_id, name)
+    tracks = dict(conn.execute('SELECT track_id, data FROM tracks WHERE track_id IN (SELECT value FROM json_each(?))',
+                               (json.dumps(track_keys),)))
+    return ([playlists[playlist_id] for playlist_id in playlist_ids if playlist_id in playlists],
+            [{**json.loads(tracks[key]),
+              'playlists': [{'id': playlist_id, 'name': name} for playlist_id, name in holders.get(key, {}).items()]}
+             for key in track_keys if key in tracks])
+
+def sqlite_load_playlist(user_id, playlist_id):
+    """Return (normalized playlist, tracks by key) of a stored playlist, as reused by syncs"""
+    conn = get_db()
+    row = conn.execute('SELECT data FROM playlists WHERE user_id = ? AND playlist_id = ?',
+                       (user_id, playlist_id)).fetchone()
+    playlist = json.loads(row[0])
+    playlist['track_ids'] = []
+    tracks = {}
+    for track_id, data in conn.execute(
+            """SELECT pt.track_id, t.data FROM playlist_tracks pt
+               LEFT JOIN tracks t ON t.track_id = pt.track_id
+               WHERE pt.user_id = ? AND pt.playlist_id = ? ORDER BY pt.position""", (user_id, playlist_id)):
+        playlist['track_ids'].append(track_id)
+        if data is not None and track_id not in tracks:
+            tracks[track_id] = json.loads(data)
+    return playlist, tracks
+
+def sqlite_get_playlist(user_id, playlist_id, lazy=False):
+    """Load one playlist and its tracks through the membership indexes"""
+    conn = get_db()
+    row = conn.execute('SELECT data FROM playlists WHERE user_id = ? AND playlist_id = ?',
+                       (user_id, playlist_id)).fetchone()
+    if row is None:
+        return None
+    other_playlists = {}
+    for track_id, other_id, other_name in conn.execute(
+            """SELECT pt.track_id, p.playlist_id, p.name
+               FROM playlist_tracks pt
+               JOIN playlists p ON p.user_id = pt.user_id AND p.playlist_id = pt.playlist_id
+               WHERE pt.user_id = ? AND pt.playlist_id != ? AND pt.track_id IN
+                   (SELECT track_id FROM playlist_tracks WHERE user_id = ? AND playlist_id = ?)
+               ORDER BY p.position""", (user_id, playlist_id, user_id, playlist_id)):
+        entries = other_playlists.setdefault(track_id, {})
+        entries.setdefault(other_id, other_name)
+    summary = json.loads(row[0])
+    summary['duplicate_tracks'] = sum(len(other_playlists.get(track_id, ())) for (track_id,) in conn.execute(
+        'SELECT track_id FROM playlist_tracks WHERE user_id = ? AND playlist_id = ?', (user_id, playlist_id)))
+
+    def iter_tracks():
+        for track_id, data in conn.execute(
+                """SELECT pt.track_id, t.data FROM playlist_tracks pt
+                   JOIN tracks t ON t.track_id = pt.track_id
+                   WHERE pt.user_id = ? AND pt.playlist_id = ? ORDER BY pt.position""", (user_id, playlist_id)):
+            track = json.loads(data)
+            track['other_playlists'] = [{'id': other_id, 'name': name}
+                                        for other_id, name in other_playlists.get(track_id, {}).items()]
+            yield track
+
+    tracks = iter_tracks()
+    return summary, tracks if lazy else list(tracks)
+
+# In-process LRU cache of full libraries: key -> (signature, library, bytes).
+# Keys are snapshot paths, validated against the file's mtime and size, or
+# ('sqlite', user_id), validated against the stored library version; the
+# decoded membership of a snapshot is kept under (path, 'membership'). Entries
+# are evicted least-recently-used first once LIBRARY_CACHE_MAX_BYTES is
+# exceeded; an entry is counted as its stored size times a rough ratio of
+# its size in memory to the stored form. Cached libraries are shared between
+# requests and must be treated as read-only.
+_library_cache = OrderedDict()
+_library_cache_bytes = 0
+_library_cache_lock = threading.Lock()
+SNAPSHOT_SIZE_FACTOR = 8  # Compressed snapshot frames
+SQLITE_SIZE_FACTOR = 4  # JSON text of SQLite rows
+
+def cached_library(key, signature, load):
+    """Return the library cached under key for this signature, or the one load() returns.
+
+    load returns (library, stored_bytes), or None if there is no library.
+    """
+    global _library_cache_bytes
+    with _library_cache_lock:
+        cached = _library_cache.get(key)
+        if cached and cached[0] == signature:
+            _library_cache.move_to_end(key)
+            return cached[1]
+
+    loaded = load()
+    if loaded is None:
+        return None
+    library, size = loaded
+
+    with _library_cache_lock:
+        previous = _library_cache.pop(key, None)
+        if previous:
+            _library_cache_bytes -= previous[2]
+        if size <= LIBRARY_CACHE_MAX_BYTES:
+            _library_cache[key] = (signature, library, size)
+            _library_cache_bytes += size
+            while _library_cache_bytes > LIBRARY_CACHE_MAX_BYTES:
+                _, (_, _, evicted_size) = _library_cache.popitem(last=False)
+                _library_cache_bytes -= evicted_size
+    return library
+
+def load_library(file_path):
+    """Return the full library stored in the snapshot at file_path, or None if it does not exist.
+
+    The library is a dict with the normalized 'data', a 'playlists_by_id' index
+    and the track 'membership' index used to resolve other_playlists.
+    """
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+
+    def load():
+        snapshot = open_snapshot(file_path)
+        if snapshot is None:
+            return None
+        size = sum(length for _, length in snapshot.frames.values()) * SNAPSHOT_SIZE_FACTOR
+        return build_library_index(snapshot.library_data()), size
+
+    return cached_library(file_path, (stat.st_mtime_ns, stat.st_size), load)
+
+def build_library_index(data):
+    """Wrap normalized library data with the lookups used by the routes"""
+    return {
+        'data': data,
+        'playlists_by_id': {p['id']: p for p in data.get('playlists', [])},
+        'membership': build_track_membership(data),
+    }
+
+# Normalized library layout: playlists hold 'track_ids' that point into a
+# single 'tracks' table, so a track shared by many playlists is stored once.
+def track_key(track):
+    """Return the key a track is stored under in the track table"""
+    return track.get('id') or track.get('uri')
+
+def playlist_full_name(playlist):
+    """Rebuild the Spotify playlist name including its folder prefix"""
+    if playlist.get('folder'):
+        return f"{playlist['folder']['path']}_{playlist['name']}"
+    return playlist['name']
+
+def add_playlist_to_library(library, playlist, tracks):
+    """Append playlist to library, moving its tracks into the shared track table; returns the stored playlist"""
+    track_ids = []
+    for track in tracks:
+        key = track_key(track)
+        if key not in library['tracks']:
+            library['tracks'][key] = project(track, TRACK_FIELDS)
+        track_ids.append(key)
+    summary = {k: v for k, v in playlist.items() if k != 'tracks'}
+    summary['track_ids'] = track_ids
+    library['playlists'].append(summary)
+    return summary
+
+def normalize_library(data):
+    """Convert data that embeds tracks in each playlist into the normalized layout"""
+    if not data or all('track_ids' in p for p in data.get('playlists', [])):
+        return data
+    library = {'playlists': [], 'tracks': dict(data.get('tracks') or {})}
+    for playlist in data.get('playlists', []):
+        if 'track_ids' in playlist:
+            library['playlists'].append(playlist)
+        else:
+            add_playlist_to_library(library, playlist, playlist.get('tracks', []))
+    return {**data, **library}
+
+# Track membership index, built once per loaded library: playlists are
+# numbered by their position, and every track key maps to a sorted array of
+# the ordinals of the playlists containing it. "Also in playlists" and
+# overlap queries are answered from it on demand.
+def build_track_membership(data):
+    """Build the track -> playlist ordinals index of a normalized library"""
+    playlists = data.get('playlists', [])
+    track_ordinals = {}
+    for ordinal, playlist in enumerate(playlists):
+        for key in playlist['track_ids']:
+            ordinals = track_ordinals.get(key)
+            if ordinals is None:
+                track_ordinals[key] = array('I', (ordinal,))
+            elif ordinals[-1] != ordinal:
+                ordinals.append(ordinal)
+    return {
+        'playlist_ids': [p['id'] for p in playlists],
+        'playlist_names': [playlist_full_name(p) for p in playlists],
+        'ordinals': {p['id']: ordinal for ordinal, p in enumerate(playlists)},
+        'tracks': track_ordinals
+    }
+
+# Inverted search index, built at sync time and stored in the library as
+# 'search_index': a sorted 'terms' list whose 'postings' hold indexes into
+# 'docs', where each doc is ['track', track_key] or ['playlist', playlist_id].
+# Sorted terms make prefix queries a bisect plus a contiguous scan.
+def tokenize(text):
+    """Split text into lowercase, accent-free word tokens"""
+    if not text:
+        return []
+    decomposed = unicodedata.normalize('NFKD', text)
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return re.findall(r'\w+', stripped.casefold())
+
+class SearchIndexBuilder:
+    """Collect search postings doc by doc; playlist docs precede track docs in the built index"""
+
+    def __init__(self):
+        self.docs = {'playlist': [], 'track': []}
+        self.term_docs = {'playlist': {}, 'track': {}}
+
+    def add(self, doc, texts):
+        kind = doc[0]
+        doc_index = len(self.docs[kind])
+        self.docs[kind].append(doc)
+        for text in texts:
+            for term in tokenize(text):
+                postings = self.term_docs[kind].setdefault(term, [])
+                if not postings or postings[-1] != doc_index:
+                    postings.append(doc_index)
+
+    def add_playlist(self, playlist):
+        folder = playlist.get('folder') or {}
+        self.add(['playlist', playlist['id']], [playlist.get('name'), folder.get('name')])
+
+    def add_track(self, key, track):
+        self.add(['track', key], [
+            track.get('name'),
+            (track.get('album') or {}).get('name'),
+            *(artist.get('name') for artist in track.get('artists') or [])
+        ])
+
+    def build(self):
+        playlist_terms, track_terms = self.term_docs['playlist'], self.term_docs['track']
+        first_track = len(self.docs['playlist'])
+        terms = sorted(playlist_terms.keys() | track_terms.keys())
+        return {
+            'docs': self.docs['playlist'] + self.docs['track'],
+            'terms': terms,
+            'postings': [playlist_terms.get(term, []) + [first_track + i for i in track_terms.get(term, ())]
+                         for term in terms]
+        }
+
+def build_search_index(data):
+    """Index track, artist, album, playlist and folder names of a normalized library"""
+    builder = SearchIndexBuilder()
+    for playlist in data.get('playlists', []):
+        builder.add_playlist(playlist)
+    for key, track in data.get('tracks', {}).items():
+        builder.add_track(key, track)
+    return builder.build()
+
+def search_matches(search_index, query, limit):
+    """Return (playlist ids, track keys) of the best matches of query, up to limit of each"""
+    playlist_ids = []
+    track_keys = []
+    for doc_type, doc_id in search_library(search_index, query):
+        found = playlist_ids if doc_type == 'playlist' else track_keys
+        if len(found) < limit:
+            found.append(doc_id)
+    return playlist_ids, track_keys
+
+def search_library(search_index, query):
+    """Return docs matching every query token as a prefix, best matches first.
+
+    Docs where more tokens match a whole term rank above prefix-only matches.
+    """
+    tokens = tokenize(query)
+    if not tokens:
+        return []
+    terms = search_index['terms']
+    postings = search_index['postings']
+    matched = None
+    exact_hits = {}
+    for token in tokens:
+        token_docs = set()
+        position = bisect.bisect_left(terms, token)
+        while position < len(terms) and terms[position].startswith(token):
+            token_docs.update(postings[position])
+            if terms[position] == token:
+                for doc_index in postings[position]:
+                    exact_hits[doc_index] = exact_hits.get(doc_index, 0) + 1
+            position += 1
+        matched = token_docs if matched is None else matched & token_docs
+        if not matched:
+            return []
+    ranked = sorted(matched, key=lambda doc_index: (-exact_hits.get(doc_index, 0), doc_index))
+    return [search_index['docs'][doc_index] for doc_index in ranked]
+
+# Library analytics, stored in the library as 'stats'. The counters cover the
+# distinct tracks of the library and are maintained incrementally: a sync
+# only removes the stored versions of changed and unlisted playlists and adds
+# the new ones (see LibraryBuilder), instead of rescanning every track.
+def empty_library_stats():
+    return {
+        'counters': {'playlists': 0, 'tracks': 0, 'duration_ms': 0, 'duplicate_tracks': 0},
+        'artists': {},
+        'decades': {},
+        'overlap': {}
+    }
+
+def _overlap_key(playlist_a, playlist_b):
+    return '|'.join(sorted((playlist_a, playlist_b)))
+
+def _track_decade(track):
+    try:
+        year = int(((track.get('album') or {}).get('release_date') or '')[:4])
+        return str(year // 10 * 10)
+    except ValueError:
+        return None
+
+def _bump(counts, key, delta):
+    value = counts.get(key, 0) + delta
+    if value:
+        counts[key] = value
+    else:
+        counts.pop(key, None)
+
+def copy_library_stats(stats):
+    return {
+        'counters': dict(stats['counters']),
+        'artists': dict(stats['artists']),
+        'decades': dict(stats['decades']),
+        'overlap': dict(stats['overlap'])
+    }
+
+def count_track_stats(stats, track, sign):
+    """Add (sign=1) or remove (sign=-1) one distinct track's contribution to stats"""
+    counters = stats['counters']
+    counters['tracks'] += sign
+    counters['duration_ms'] += sign * (track.get('duration_ms') or 0)
+    for artist in track.get('artists') or []:
+        _bump(stats['artists'], artist.get('name'), sign)
+    decade = _track_decade(track)
+    if decade:
+        _bump(stats['decades'], decade, sign)
+
+class StatsMembership(dict):
+    """Track key -> ids of the playlists counted in stats, loaded by load_holders(key) on first use"""
+
+    def __init__(self, load_holders):
+        super().__init__()
+        self.load_holders = load_holders
+
+    def __missing__(self, key):
+        holders = self[key] = set(self.load_holders(key))
+        return holders
+
+def apply_playlist_stats(stats, membership, playlist, tracks, sign):
+    """Add (sign=1) or remove (sign=-1) one playlist's contribution to stats.
+
+    membership maps track keys to the set of playlist ids currently counted
+    and is updated along with stats.
+    """
+    counters = stats['counters']
+    playlist_id = playlist['id']
+    for key in set(playlist['track_ids']):
+        others = membership[key]
+        if sign < 0:
+            if playlist_id not in others:
+                continue
+            others.discard(playlist_id)
+        elif playlist_id in others:
+            continue
+        for other_id in others:
+            _bump(stats['overlap'], _overlap_key(playlist_id, other_id), sign)
+        if len(others) == 1:
+            counters['duplicate_tracks'] += sign
+        if not others:
+            # First or last playlist holding this track
+            count_track_stats(stats, tracks.get(key) or {}, sign)
+        if sign > 0:
+            others.add(playlist_id)
+    counters['playlists'] += sign
+
+def build_library_stats(data):
+    """Compute the stats of a normalized library stored without them"""
+    builder = LibraryBuilder()
+    for playlist in data.get('playlists', []):
+        builder.add_playlist(playlist, data['tracks'])
+    return builder.stats
+
+STATS_TOP_N = 20
 
-def create_spotify_oauth():
-    return SpotifyOAuth(
-        client_id=SPOTIFY_CLIENT_ID,
-        client_secret=SPOTIFY_CLIENT_SECRET,
-        redirect_uri=SPOTIFY_REDIRECT_URI,
-        scope=SCOPE,
-        cache_path='.spotify_cache'  # Enable token caching
-    )
+def stats_view(stats, most_shared, playlist_name):
+    """Turn stats counters into the /stats response body.
 
-def get_spotify():
-    """Get an authenticated Spotify client with proper timeout settings"""
-    try:
-        if 'token_info' not in session:
-            print("No token info in session")
-            return None
-            
-        # Create Spotify client
-        token_info = session['token_info']
-        
-        # Check if token is expired
-        now = int(time.time())
-        is_expired = token_info['expires_at'] - now < 60
-        
-        if is_expired:
-            print("Token is expired, trying to refresh...")
-            try:
-                # Create a Spotify OAuth instance with timeout settings
-                sp_oauth = SpotifyOAuth(
-                    client_id=SPOTIFY_CLIENT_ID,
-                    client_secret=SPOTIFY_CLIENT_SECRET,
-                    redirect_uri=SPOTIFY_REDIRECT_URI,
-                    scope=SCOPE,
-                    requests_timeout=300,  # 5 minutes timeout
-                    retries=3,  # Retry failed requests
-                    cache_path='.spotify_cache'
-                )
-                
-                # Try to refresh the token
-                token_info = sp_oauth.refresh_access_token(token_info['refresh_token'])
-                session['token_info'] = token_info
-                print("Token refreshed successfully")
-            except Exception as e:
-                print(f"Error refreshing token: {str(e)}")
-                return None
-                
-        # Create client with timeout settings
-        sp = spotipy.Spotify(
-            auth=token_info['access_token'],
-            requests_timeout=300,  # 5 minutes timeout
-            retries=3  # Retry failed requests
-        )
-        return sp
-        
-    except Exception as e:
-        print(f"Error in get_spotify: {str(e)}")
-        return None
+    most_shared lists (track key, track name, playlist count) of the most
+    shared tracks; playlist_name returns a playlist id's full name or None.
+    """
+    def playlist_ref(playlist_id):
+        return {'id': playlist_id, 'name': playlist_name(playlist_id) or playlist_id}
 
-def fetch_with_retry(func, *args, max_retries=3, **kwargs):
-    for attempt in range(max_retries):
-        try:
-            return func(*args, **kwargs)
-        except Exception as e:
-            if attempt == max_retries - 1:
-                raise
-            time.sleep(1)
+    top_artists = sorted(stats['artists'].items(), key=lambda item: (-item[1], item[0]))[:STATS_TOP_N]
+    top_overlap = sorted(stats['overlap'].items(), key=lambda item: -item[1])[:STATS_TOP_N]
+    return {
+        **stats['counters'],
+        'artists': len(stats['artists']),
+        'top_artists': [{'name': name, 'tracks': count} for name, count in top_artists],
+        'decades': [{'decade': int(decade), 'tracks': count}
+                    for decade, count in sorted(stats['decades'].items())],
+        'most_shared_tracks': [{'id': key, 'name': name, 'playlists': count} for key, name, count in most_shared],
+        'top_overlap': [{'playlists': [playlist_ref(p) for p in pair.split('|')], 'shared_tracks': count}
+                        for pair, count in top_overlap]
+    }
 
-def get_all_items(sp, initial_request, get_next):
-    items = []
-    results = initial_request
-    
-    while results:
-        items.extend(results['items'])
-        if not results['next']:
-            break
-        try:
-            results = fetch_with_retry(get_next, results)
-        except Exception as e:
-            break
-    
-    return items
+def build_stats_view(library):
+    """Build the /stats response body of a loaded library"""
+    data = library['data']
+    stats = data.get('stats') or build_library_stats(data)
+    playlists_by_id = library['playlists_by_id']
+    shared_tracks = sorted(((key, len(ordinals)) for key, ordinals in library['membership']['tracks'].items()
+                            if len(ordinals) > 1),
+                           key=lambda item: -item[1])[:STATS_TOP_N]
+    return stats_view(
+        stats,
+        [(key, (data['tracks'].get(key) or {}).get('name'), count) for key, count in shared_tracks],
+        lambda playlist_id: playlist_full_name(playlists_by_id[playlist_id]) if playlist_id in playlists_by_id else None)
 
-# Add data storage functions
-def save_user_data(user_id, data):
-    try:
-        file_path = os.path.join(DATA_DIR, f'{user_id}.json')
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f)
-        print(f"Successfully saved data for user {user_id}")
-        return True
-    except Exception as e:
-        print(f"Error saving data for user {user_id}: {str(e)}")
-        return False
+def split_unchanged_playlists(items, stored_snapshot_ids):
+    """Split playlist listing items into (unchanged, changed) by snapshot_id.
 
-def load_user_data(user_id):
-    try:
-        file_path = os.path.join(DATA_DIR, f'{user_id}.json')
-        if os.path.exists(file_path):
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                print(f"Successfully loaded data for user {user_id}")
-                return data
-        print(f"No data file found for user {user_id}")
-        return None
-    except Exception as e:
-        print(f"Error loading data for user {user_id}: {str(e)}")
-        return None
+    stored_snapshot_ids maps the ids of stored playlists to their snapshot
+    ids; unchanged items can be reused without fetching the playlist again.
+    """
+    unchanged = []
+    changed = []
+    for item in items:
+        stored_snapshot_id = stored_snapshot_ids.get(item['id'])
+        if stored_snapshot_id and stored_snapshot_id == item.get('snapshot_id'):
+            unchanged.append(item)
+        else:
+            changed.append(item)
+    return unchanged, changed
 
-def optimize_playlist_data(playlist, tracks, track_playlist_map):
+def optimize_playlist_data(playlist, tracks):
     """Pre-calculate and cache useful playlist information"""
     # Calculate total duration
     total_duration_ms = sum(track['duration_ms'] for track in tracks)
@@ -183,14 +2186,6 @@ def optimize_playlist_data(playlist, tracks, track_playlist_map):
             except (ValueError, TypeError):
                 pass
     
-    # Add other playlists information to tracks
-    for track in tracks:
-        other_playlists = []
-        if track['id'] in track_playlist_map:
-            other_playlists = [p for p in track_playlist_map[track['id']] 
-                             if p['id'] != playlist['id']]
-        track['other_playlists'] = other_playlists
-    
     # Parse folder path from playlist name
     folder = None
     name = playlist['name']
@@ -206,6 +2201,7 @@ def optimize_playlist_data(playlist, tracks, track_playlist_map):
     
     return {
         'id': playlist['id'],
+        'snapshot_id': playlist.get('snapshot_id'),
         'name': name,
         'description': playlist.get('description', ''),
         'images': playlist.get('images', []),
@@ -236,36 +2232,152 @@ def format_duration(ms):
         return f"{hours}h {minutes}m"
     return f"{minutes}m {seconds}s"
 
-def get_git_version():
+# Build info, resolved once at startup
+VERSION_ENV_VARS = ('DEPLOYED_VERSION', 'RENDER_GIT_COMMIT', 'GIT_COMMIT', 'SOURCE_VERSION')
+
+def read_git_commit(git_dir):
+    """Return the commit checked out in git_dir, following HEAD through loose or packed refs"""
+    with open(os.path.join(git_dir, 'HEAD'), 'r') as f:
+        head = f.read().strip()
+    if not head.startswith('ref: '):
+        return head  # Detached HEAD
+    ref = head[len('ref: '):]
     try:
-        with open('.git/refs/heads/main', 'r') as f:
-            return f.read().strip()[:7]  # Get first 7 characters of commit hash
-    except Exception as e:
-        print(f"Error getting git version: {str(e)}")
-        return 'unknown'
+        with open(os.path.join(git_dir, ref), 'r') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+    with open(os.path.join(git_dir, 'packed-refs'), 'r') as f:
+        for line in f:
+            commit, _, name = line.strip().partition(' ')
+            if name == ref:
+                return commit
+    return None
+
+def get_deployed_version():
+    """Return the short commit hash being served, from the environment or the git checkout"""
+    for name in VERSION_ENV_VARS:
+        if os.getenv(name):
+            return os.getenv(name)[:7]
+    try:
+        commit = read_git_commit(os.path.join(os.path.dirname(os.path.abspath(__file__)), '.git'))
+        if commit:
+            return commit[:7]
+    except OSError as e:
+        logger.info("No git checkout to read the deployed version from: %s", e)
+    return 'unknown'
+
+DEPLOYED_VERSION = get_deployed_version()
+app.jinja_env.globals['deployed_version'] = DEPLOYED_VERSION
+
+_static_versions = {}
+
+@app.url_defaults
+def add_static_version(endpoint, values):
+    """Append the file's mtime to static URLs so they can be cached indefinitely"""
+    if endpoint == 'static' and 'filename' in values:
+        filename = values['filename']
+        version = _static_versions.get(filename)
+        if version is None:
+            try:
+                version = int(os.stat(os.path.join(app.static_folder, filename)).st_mtime)
+            except OSError:
+                return
+            # Static files only change with a deploy, except while developing
+            if not app.debug:
+                _static_versions[filename] = version
+        values['v'] = version
+
+def negotiate_encoding():
+    """Return the best content coding the client accepts: 'br', 'gzip' or None"""
+    return request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
 
-@app.context_processor
-def inject_git_version():
-    return dict(deployed_version=get_git_version())
+def compress_response(response, encoding):
+    """Compress a response body in place, chunk by chunk when it is streamed"""
+    if response.is_streamed:
+        chunks = response.response
+
+        def generate():
+            if encoding == 'br':
+                compressor = brotli.Compressor(quality=5)
+                for chunk in chunks:
+                    yield compressor.process(chunk if isinstance(chunk, bytes) else chunk.encode()) + compressor.flush()
+                yield compressor.finish()
+            else:
+                compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                for chunk in chunks:
+                    yield compressor.compress(chunk if isinstance(chunk, bytes) else chunk.encode()) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                yield compressor.flush()
+
+        response.response = generate()
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_BYTES:
+            return response
+        response.set_data(brotli.compress(data, quality=5) if encoding == 'br' else gzip.compress(data, 6))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def start_template_timer(sender, template, context, **extra):
+    g.template_started = time.perf_counter()
+
+def record_template_metrics(sender, template, context, **extra):
+    started = g.pop('template_started', None)
+    if started is not None:
+        template_render_seconds.observe(time.perf_counter() - started, template.name or 'string')
+
+before_render_template.connect(start_template_timer, app)
+template_rendered.connect(record_template_metrics, app)
+
+NO_CACHE_HEADERS = {
+    'Cache-Control': 'no-cache, no-store, must-revalidate',
+    'Pragma': 'no-cache',
+    'Expires': '0',
+}
+STATIC_CACHE_CONTROL = f'public, max-age={STATIC_MAX_AGE}, immutable'
+# Any origin may call the API with credentials; the origin is echoed back
+CORS_HEADERS = {
+    'Access-Control-Allow-Credentials': 'true',
+    'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type',
+}
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
 
 @app.after_request
 def after_request(response):
-    """Add headers to both force latest IE rendering engine or Chrome Frame,
-    and also to cache the rendered page for 10 minutes."""
-    response.headers["X-UA-Compatible"] = "IE=Edge,chrome=1"
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers["Pragma"] = "no-cache"
-    response.headers["Expires"] = "0"
-    
-    # Handle CORS
+    """The single response middleware: add headers to force the latest IE rendering
+    engine or Chrome Frame, set the caching policy and CORS headers, compress
+    bodies the client accepts compressed and record the route latency."""
+    headers = response.headers
+    headers['X-UA-Compatible'] = 'IE=Edge,chrome=1'
+    # Responses that set their own policy (static files, library endpoints
+    # with validators) keep it; everything else must not be cached
+    if request.endpoint == 'static' and 'v' in request.args:
+        headers['Cache-Control'] = STATIC_CACHE_CONTROL
+    elif 'Cache-Control' not in headers:
+        headers.update(NO_CACHE_HEADERS)
+
+    if (response.mimetype in COMPRESSIBLE_MIMETYPES and response.status_code == 200
+            and not response.direct_passthrough and 'Content-Encoding' not in response.headers):
+        response.vary.add('Accept-Encoding')
+        encoding = negotiate_encoding()
+        if encoding:
+            compress_response(response, encoding)
+
     origin = request.headers.get('Origin')
     if origin:
-        # Allow the specific origin that made the request
-        response.headers["Access-Control-Allow-Origin"] = origin
-        response.headers["Access-Control-Allow-Credentials"] = "true"
-        response.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
-        response.headers["Access-Control-Allow-Headers"] = "Content-Type"
-    
+        headers['Access-Control-Allow-Origin'] = origin
+        headers.update(CORS_HEADERS)
+        response.vary.add('Origin')
+
+    started = g.pop('request_started', None)
+    if started is not None:
+        http_request_seconds.observe(time.perf_counter() - started, request.endpoint or 'unmatched',
+                                     request.method, str(response.status_code))
     return response
 
 @app.route('/')
@@ -281,39 +2393,35 @@ def index():
         session['user_id'] = user_id
         
         # Look for user's data file
-        data_dir = DATA_DIR
-        user_file = os.path.join(data_dir, f'{user_id}.json')
-        
-        if os.path.exists(user_file):
-            print(f"Found data file for user: {user_id}")
-            with open(user_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                print("Loaded data:", {
-                    'num_playlists': len(data.get('playlists', [])),
-                    'num_tracks': len(data.get('tracks', {})),
-                    'last_sync': data.get('last_sync', 0)
-                })
-                return render_template('playlists.html',
-                                    playlists=json.dumps(data.get('playlists', [])),
-                                    tracks=json.dumps(data.get('tracks', {})),
-                                    current_playlist=json.dumps(None),
-                                    last_sync=data.get('last_sync', 0))
+        found = get_user_playlists(user_id)
+        if found:
+            playlists, last_sync = found
+            logger.debug("Found library of user %s: %s playlists, last sync %s", user_id, len(playlists), last_sync)
+            # Playlists are fetched page by page from /playlists by the client
+            return render_template('playlists.html',
+                                playlists=json.dumps([]),
+                                tracks=json.dumps({}),
+                                current_playlist=json.dumps(None),
+                                last_sync=last_sync,
+                                page_size=PLAYLIST_PAGE_SIZE)
                                     
         # No data file found, start sync process
-        print(f"No data file found for user: {user_id}")
+        logger.debug("No data file found for user: %s", user_id)
         return render_template('playlists.html',
                             playlists=json.dumps([]),
                             tracks=json.dumps({}),
                             current_playlist=json.dumps(None),
-                            last_sync=0)
+                            last_sync=0,
+                            page_size=PLAYLIST_PAGE_SIZE)
                             
     except Exception as e:
-        print(f"Error loading data: {str(e)}")
+        logger.error("Error loading data: %s", e)
         return render_template('playlists.html',
                             playlists=json.dumps([]),
                             tracks=json.dumps({}),
                             current_playlist=json.dumps(None),
-                            last_sync=0)
+                            last_sync=0,
+                            page_size=PLAYLIST_PAGE_SIZE)
 
 @app.route('/login')
 def login():
@@ -339,14 +2447,18 @@ def callback():
         return redirect(url_for('login'))
     
     try:
-        token_info = sp_oauth.get_access_token(code)
-        session['token_info'] = token_info
+        token_info = sp_oauth.get_access_token(code, check_cache=False)
+        user_id = RateLimitedSpotify(auth=token_info['access_token'], requests_session=spotify_http_session,
+                                     requests_timeout=SPOTIFY_REQUEST_TIMEOUT).current_user()['id']
+        token_manager.save(user_id, token_info)
+        session['user_id'] = user_id
         return redirect(url_for('index'))
     except Exception as e:
         return f"Error getting access token: {str(e)}"
 
 @app.route('/logout')
 def logout():
+    # Only this browser is logged out; the stored token keeps serving the user's other sessions and syncs
     session.clear()
     return redirect(url_for('index'))
 
@@ -369,9 +2481,644 @@ def get_playlist_folder_info(sp):
         
         return folders, folder_contents
     except Exception as e:
-        print(f"Error getting folder info: {str(e)}")
+        logger.error("Error getting folder info: %s", e)
         return [], {}
 
+def format_sse(data, event_id=None):
+    try:
+        if isinstance(data, dict):
+            if 'progress' in data:
+                progress = data['progress']
+                data = {
+                    'type': 'progress',
+                    'data': {
+                        'current': int(progress.get('current', 0)),
+                        'total': int(progress.get('total', 0)),
+                        'playlist': str(progress.get('playlist', ''))
+                    }
+                }
+            elif 'playlist' in data:
+                data = {
+                    'type': 'playlist',
+                    'data': {
+                        'current': int(data.get('current', 0)),
+                        'total': int(data.get('total', 0)),
+                        'playlist': data['playlist']
+                    }
+                }
+            elif 'success' in data:
+                data = {
+                    'type': 'complete',
+                    'data': {
+                        'success': bool(data.get('success')),
+                        'error': str(data.get('error', '')),
+                        'last_sync': int(data.get('last_sync', 0))
+                    }
+                }
+        json_str = json.dumps(data, default=str)
+        if event_id is not None:
+            return f"id: {event_id}\ndata: {json_str}\n\n"
+        return f"data: {json_str}\n\n"
+    except Exception as e:
+        logger.error("Error formatting SSE data: %s", e)
+        return f"data: {{\"type\":\"error\",\"message\":\"Internal server error\"}}\n\n"
+
+class SyncBaseline:
+    """The playlists a sync may reuse unchanged: those of the stored library and of an interrupted sync.
+
+    Only their snapshot ids are held; a reused playlist and its tracks are
+    read from storage when the sync reaches it. The stored library's stats,
+    if it has any, are the starting point of the new library's.
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.snapshot = None
+        self.keys = None
+        self.key_rows = None
+        self.stats = None
+        self.checkpoint = {}
+        self.staged = {}
+        if STORAGE_BACKEND == 'sqlite':
+            conn = get_db()
+            query = 'SELECT playlist_id, snapshot_id FROM playlists WHERE user_id = ?'
+            self.stored_ids = dict(conn.execute(query, (user_id,)))
+            row = conn.execute("SELECT data FROM library_extras WHERE user_id = ? AND name = 'stats'",
+                               (user_id,)).fetchone()
+            self.stats = json.loads(row[0]) if row else None
+            # Resume from playlists staged by an interrupted sync
+            self.staged = dict(conn.execute(query, (sqlite_staging_id(user_id),)))
+            self.snapshot_ids = {**self.stored_ids, **self.staged}
+            if self.staged:
+                logger.info("Resuming sync with %s staged playlists", len(self.staged))
+            return
+        self.snapshot = open_snapshot(user_data_path(user_id))
+        if self.snapshot:
+            self.stored_ids = {p['id']: p.get('snapshot_id') for p in self.snapshot.meta()['playlists']}
+            self.stats = self.snapshot.frame('stats')
+        else:
+            self.stored_ids = {}
+        # Resume from playlists checkpointed by an interrupted sync
+        self.checkpoint = index_sync_checkpoint(user_id)
+        self.snapshot_ids = {**self.stored_ids,
+                             **{playlist_id: snapshot_id for playlist_id, (snapshot_id, _) in self.checkpoint.items()}}
+        if self.checkpoint:
+            logger.info("Resuming sync with %s checkpointed playlists", len(self.checkpoint))
+
+    def counted(self, playlist_id):
+        """Return whether the stored stats count the copy of a playlist that load() returns"""
+        return (self.stats is not None and playlist_id in self.stored_ids
+                and playlist_id not in self.checkpoint and playlist_id not in self.staged)
+
+    def load(self, playlist_id, known=()):
+        """Return (normalized playlist, tracks by key) of a reusable playlist, preferring an interrupted sync's copy"""
+        if playlist_id in self.checkpoint:
+            return read_sync_checkpoint(self.user_id, self.checkpoint[playlist_id][1])
+        if playlist_id in self.staged:
+            return sqlite_load_playlist(sqlite_staging_id(self.user_id), playlist_id)
+        return self.load_stored(playlist_id, known)
+
+    def load_stored(self, playlist_id, known=()):
+        """Return (normalized playlist, tracks by key) of a playlist of the stored library.
+
+        Tracks whose keys are in known may be left out of a playlist read from
+        the snapshot, which then decodes only the track table frames holding
+        the others.
+        """
+        if self.snapshot is None:
+            return sqlite_load_playlist(self.user_id, playlist_id)
+        keys = self.stored_keys()
+        summary, _, rows = self.snapshot.playlist_rows(playlist_id)
+        playlist = {k: v for k, v in summary.items() if k != 'duplicate_tracks'}
+        playlist['track_ids'] = [keys[row] for row in rows]
+        unknown = [row for row in rows if keys[row] not in known]
+        return playlist, {keys[row]: track for row, track in self.snapshot.iter_tracks(unknown)}
+
+    def stored_keys(self):
+        if self.keys is None:
+            self.keys = self.snapshot.frame('membership')['keys']
+        return self.keys
+
+    def stored_holders(self, key):
+        """Return the ids of the stored library's playlists holding a track"""
+        if self.snapshot is None:
+            return [playlist_id for (playlist_id,) in get_db().execute(
+                'SELECT DISTINCT playlist_id FROM playlist_tracks WHERE user_id = ? AND track_id = ?',
+                (self.user_id, key))]
+        if self.key_rows is None:
+            self.key_rows = {key: row for row, key in enumerate(self.stored_keys())}
+        row = self.key_rows.get(key)
+        if row is None:
+            return ()
+        offsets, ordinals = self.snapshot.membership()
+        playlists = self.snapshot.meta()['playlists']
+        return [playlists[ordinal]['id'] for ordinal in ordinals[offsets[row]:offsets[row + 1]]]
+
+def sync_progress(current, total, playlist=None):
+    progress = {'current': current, 'total': total}
+    if playlist is not None:
+        progress['playlist'] = playlist
+    return {'progress': progress}
+
+def sync_playlist_event(current, total, playlist):
+    """Announce a synced playlist: its summary as listed by /playlists, without duplicate counts"""
+    return {'playlist': {k: v for k, v in playlist.items() if k != 'track_ids'}, 'current': current, 'total': total}
+
+def add_stored_playlist(writer, baseline, playlist_id):
+    """Add a playlist unchanged since the previous sync from its stored copy; returns it"""
+    playlist, tracks = baseline.load(playlist_id, writer.rows)
+    writer.add_playlist(playlist, tracks, stored=True, counted=baseline.counted(playlist_id))
+    return playlist
+
+def add_fetched_playlist(writer, baseline, item, full_playlist, playlist_tracks, error):
+    """Add a playlist fetched from Spotify; returns it, or None if it could not be fetched or processed.
+
+    A playlist that failed keeps its stored copy, if there is one, until a
+    later sync fetches it.
+    """
+    if error is None:
+        try:
+            optimized_playlist = optimize_playlist_data(full_playlist, playlist_tracks)
+            library = {'playlists': [], 'tracks': {}}
+            playlist = add_playlist_to_library(library, optimized_playlist, optimized_playlist['tracks'])
+        except Exception as e:
+            error = e
+    if error is not None:
+        logger.error("Error processing playlist %s: %s", item['name'], error)
+        if item['id'] in baseline.snapshot_ids:
+            return add_stored_playlist(writer, baseline, item['id'])
+        return None
+    writer.add_playlist(playlist, library['tracks'])
+    return playlist
+
+def finish_sync(user_id, writer):
+    """Finalize the synced library with its derived sections and return the completion event.
+
+    The event only carries the outcome; clients fetch the saved library page by
+    page from /playlists.
+    """
+    last_sync = int(time.time())
+    try:
+        with json_dump_seconds.time('sqlite' if STORAGE_BACKEND == 'sqlite' else 'snapshot'):
+            writer.finish(last_sync)
+    except Exception as e:
+        logger.error("Error saving data for user %s: %s", user_id, e)
+        return {
+            'success': False,
+            'error': 'Failed to save data'
+        }
+    logger.debug("Successfully saved data for user %s", user_id)
+    return {
+        'success': True,
+        'last_sync': last_sync
+    }
+
+SYNC_LISTING_PAGE_SIZE = 50  # Maximum page size of the current user's playlists endpoint
+
+def sync_user_library(sp, user_id):
+    """Sync a user's whole library from Spotify, yielding an event per synced playlist and a completion event.
+
+    Playlists are synced one listing page at a time: a page's playlists are
+    fetched concurrently and each is written to storage as it completes, and
+    the page is checkpointed before the next one is requested, so the requests
+    in flight are bounded by the page size.
+    """
+    baseline = SyncBaseline(user_id)
+    writer = open_library_writer(user_id, baseline)
+    # Bounded pool shared by playlist and track page requests
+    executor = ThreadPoolExecutor(max_workers=SYNC_MAX_WORKERS)
+    try:
+        results = sp.current_user_playlists(limit=SYNC_LISTING_PAGE_SIZE)
+        total = results['total']
+        processed = 0
+        yield sync_progress(0, total, 'Starting...')
+        while results:
+            unchanged, changed = split_unchanged_playlists(results['items'], baseline.snapshot_ids)
+            for item in unchanged:
+                processed += 1
+                yield sync_playlist_event(processed, total, add_stored_playlist(writer, baseline, item['id']))
+            for item, full_playlist, playlist_tracks, error in fetch_playlists_concurrently(sp, changed, executor):
+                processed += 1
+                playlist = add_fetched_playlist(writer, baseline, item, full_playlist, playlist_tracks, error)
+                if playlist:
+                    yield sync_playlist_event(processed, total, playlist)
+            writer.checkpoint()
+            results = sp.next(results) if results['next'] else None
+        # FINAL message
+        yield finish_sync(user_id, writer)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        writer.discard()
+
+async def sync_user_library_async(sp, user_id):
+    """Asyncio counterpart of sync_user_library on an AsyncSpotify client, yielding the same events.
+
+    Blocking storage work runs in the default executor so the event loop keeps
+    serving the other syncs.
+    """
+    baseline = await asyncio.to_thread(SyncBaseline, user_id)
+    writer = await asyncio.to_thread(open_library_writer, user_id, baseline)
+    try:
+        results = await sp.current_user_playlists(limit=SYNC_LISTING_PAGE_SIZE)
+        total = results['total']
+        processed = 0
+        yield sync_progress(0, total, 'Starting...')
+        while results:
+            unchanged, changed = split_unchanged_playlists(results['items'], baseline.snapshot_ids)
+            for item in unchanged:
+                processed += 1
+                playlist = await asyncio.to_thread(add_stored_playlist, writer, baseline, item['id'])
+                yield sync_playlist_event(processed, total, playlist)
+            async for item, full_playlist, playlist_tracks, error in fetch_playlists_async(sp, changed):
+                processed += 1
+                playlist = await asyncio.to_thread(add_fetched_playlist, writer, baseline, item, full_playlist,
+                                                   playlist_tracks, error)
+                if playlist:
+                    yield sync_playlist_event(processed, total, playlist)
+            await asyncio.to_thread(writer.checkpoint)
+            results = await sp.next(results) if results['next'] else None
+        yield await asyncio.to_thread(finish_sync, user_id, writer)
+    finally:
+        writer.discard()
+
+# Background sync jobs. A sync runs in its own thread (or, with the asyncio
+# engine, as a task on the process's sync event loop), independent of the SSE
+# request that started it; /sync_library attaches to the user's running job
+# (or to a finished one it names by job_id) and replays its events, so
+# reconnecting never starts a second sync for the same user.
+SYNC_JOB_RETENTION_SECONDS = 300  # How long a finished job stays attachable
+SSE_KEEPALIVE_SECONDS = 15
+SYNC_LEASE_SECONDS = 60  # A lease not renewed for this long belongs to a dead worker
+SYNC_EVENT_POLL_SECONDS = 0.5
+SYNC_EVENT_BUFFER = 256  # Latest events of a job kept in memory; older ones are replayed from sync_events
+
+# Sync coordination between worker processes. gunicorn workers share no
+# memory, so each sync holds a lease row in the coordination database and
+# records its events there: only the lease holder syncs (and writes) a user's
+# library, and the other workers stream its events from the table.
+COORDINATION_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sync_jobs (
+    job_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    heartbeat REAL NOT NULL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS sync_jobs_by_user ON sync_jobs (user_id, finished_at);
+CREATE TABLE IF NOT EXISTS sync_events (
+    job_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    event TEXT NOT NULL,
+    PRIMARY KEY (job_id, seq)
+);
+"""
+
+def get_coordination_db():
+    """Return this thread's connection to the coordination database"""
+    conn = getattr(_sqlite_local, 'coordination', None)
+    if conn is None:
+        conn = _sqlite_local.coordination = open_sqlite(COORDINATION_DB_PATH, COORDINATION_SCHEMA)
+    return conn
+
+def acquire_sync_lease(user_id):
+    """Return (job_id, owned): a live sync of the user, or a new job whose lease we now hold"""
+    conn = get_coordination_db()
+    now = time.time()
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute(
+            'SELECT job_id FROM sync_jobs WHERE user_id = ? AND finished_at IS NULL AND heartbeat > ?',
+            (user_id, now - SYNC_LEASE_SECONDS)).fetchone()
+        if row:
+            return row[0], False
+        # Close the leases of dead workers and forget jobs past retention
+        conn.execute('UPDATE sync_jobs SET finished_at = ? WHERE user_id = ? AND finished_at IS NULL', (now, user_id))
+        conn.execute("""DELETE FROM sync_events WHERE job_id IN
+                        (SELECT job_id FROM sync_jobs WHERE finished_at < ?)""", (now - SYNC_JOB_RETENTION_SECONDS,))
+        conn.execute('DELETE FROM sync_jobs WHERE finished_at < ?', (now - SYNC_JOB_RETENTION_SECONDS,))
+        job_id = uuid.uuid4().hex
+        conn.execute('INSERT INTO sync_jobs (job_id, user_id, heartbeat) VALUES (?, ?, ?)', (job_id, user_id, now))
+    return job_id, True
+
+def renew_sync_lease(job_id):
+    conn = get_coordination_db()
+    with conn:
+        conn.execute('UPDATE sync_jobs SET heartbeat = ? WHERE job_id = ?', (time.time(), job_id))
+
+def release_sync_lease(job_id):
+    conn = get_coordination_db()
+    with conn:
+        conn.execute('UPDATE sync_jobs SET finished_at = ? WHERE job_id = ?', (time.time(), job_id))
+
+def record_sync_event(job_id, seq, event):
+    conn = get_coordination_db()
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO sync_events (job_id, seq, event) VALUES (?, ?, ?)',
+                     (job_id, seq, json.dumps(event, default=str)))
+
+def read_sync_events(job_id, start, end=None):
+    """Return the recorded (seq, event) of a job from seq start on, up to end if given"""
+    query = 'SELECT seq, event FROM sync_events WHERE job_id = ? AND seq >= ?'
+    params = (job_id, start)
+    if end is not None:
+        query += ' AND seq < ?'
+        params += (end,)
+    return [(seq, json.loads(event)) for seq, event in
+            get_coordination_db().execute(query + ' ORDER BY seq', params)]
+
+def find_sync_job(job_id, user_id):
+    """Return whether job_id is a recorded sync job of the user"""
+    return get_coordination_db().execute(
+        'SELECT 1 FROM sync_jobs WHERE job_id = ? AND user_id = ?', (job_id, user_id)).fetchone() is not None
+
+class SyncJob:
+    """A library sync running in a background thread, with its recorded events.
+
+    Only the latest SYNC_EVENT_BUFFER events are kept in memory; consumers
+    further behind, such as reconnecting clients, read the older ones from the
+    coordination database.
+    """
+
+    def __init__(self, user_id, job_id=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.user_id = user_id
+        self.started = time.monotonic()
+        self.events = deque(maxlen=SYNC_EVENT_BUFFER)
+        self.event_count = 0
+        self.done = False
+        self.finished_at = None
+        self.condition = threading.Condition()
+        self.async_waiters = set()  # (loop, asyncio.Event) of stream_async consumers
+
+    def notify(self):
+        """Wake up every consumer; called with the condition held"""
+        self.condition.notify_all()
+        for loop, waiter in self.async_waiters:
+            loop.call_soon_threadsafe(waiter.set)
+
+    def publish(self, event):
+        with self.condition:
+            seq = self.event_count
+            self.events.append(event)
+            self.event_count += 1
+            self.notify()
+        try:
+            record_sync_event(self.id, seq, event)
+        except Exception as e:
+            logger.error("Error recording event of sync job %s: %s", self.id, e)
+
+    def keep_lease(self, stopped):
+        while not stopped.wait(SYNC_LEASE_SECONDS / 4):
+            try:
+                renew_sync_lease(self.id)
+            except Exception as e:
+                logger.error("Error renewing lease of sync job %s: %s", self.id, e)
+
+    def run(self, sp):
+        stopped = threading.Event()
+        threading.Thread(target=self.keep_lease, args=(stopped,), daemon=True).start()
+        try:
+            for event in sync_user_library(sp, self.user_id):
+                self.publish(event)
+        except Exception as e:
+            logger.error("Exception in sync job %s: %s", self.id, e)
+            self.publish({'type': 'error', 'message': str(e)})
+        finally:
+            stopped.set()
+            self.finish('threads')
+
+    async def run_async(self, sp):
+        """Run the sync on the current event loop with an AsyncSpotify client"""
+        async def keep_lease():
+            while True:
+                await asyncio.sleep(SYNC_LEASE_SECONDS / 4)
+                try:
+                    await asyncio.to_thread(renew_sync_lease, self.id)
+                except Exception as e:
+                    logger.error("Error renewing lease of sync job %s: %s", self.id, e)
+
+        lease_task = asyncio.create_task(keep_lease())
+        try:
+            async for event in sync_user_library_async(sp, self.user_id):
+                self.publish(event)
+        except Exception as e:
+            logger.error("Exception in sync job %s: %s", self.id, e)
+            self.publish({'type': 'error', 'message': str(e)})
+        finally:
+            lease_task.cancel()
+            self.finish('asyncio')
+
+    def finish(self, engine):
+        succeeded = bool(self.events) and bool(self.events[-1].get('success'))
+        sync_jobs_total.inc(engine, 'success' if succeeded else 'error')
+        sync_seconds.observe(time.monotonic() - self.started, engine)
+        try:
+            release_sync_lease(self.id)
+        except Exception as e:
+            logger.error("Error releasing lease of sync job %s: %s", self.id, e)
+        with self.condition:
+            self.done = True
+            self.finished_at = time.time()
+            self.notify()
+
+    def take(self, index, waiter=None):
+        """Return (buffered (seq, event) from index on, seq of the first buffered event, done).
+
+        Shared by stream and stream_async; the asyncio.Event waiter of
+        stream_async is cleared under the same lock, so a publish after
+        reading is not missed.
+        """
+        with self.condition:
+            if waiter is not None:
+                waiter.clear()
+            first = self.event_count - len(self.events)
+            pending = [(first + offset, event) for offset, event in enumerate(self.events) if first + offset >= index]
+            return pending, first, self.done
+
+    def wait(self, index):
+        """Wait for an event after index or the end of the job; False when the keepalive interval passed"""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.event_count > index or self.done, SSE_KEEPALIVE_SECONDS)
+
+    def stream(self, start=0):
+        """Yield (index, event) from start on until the job ends; (None, None) marks an idle interval"""
+        index = start
+        while True:
+            pending, first, done = self.take(index)
+            if index < first:
+                pending = read_sync_events(self.id, index, first) + pending
+            yield from pending
+            if pending:
+                index = pending[-1][0] + 1
+            elif done:
+                return
+            elif not self.wait(index):
+                yield None, None
+
+    async def stream_async(self, start=0):
+        """Asyncio counterpart of stream, for consumers running on an event loop"""
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self.condition:
+            self.async_waiters.add(waiter)
+        try:
+            index = start
+            while True:
+                pending, first, done = self.take(index, waiter[1])
+                if index < first:
+                    pending = await asyncio.to_thread(read_sync_events, self.id, index, first) + pending
+                for item in pending:
+                    yield item
+                if pending:
+                    index = pending[-1][0] + 1
+                elif done:
+                    return
+                else:
+                    try:
+                        await asyncio.wait_for(waiter[1].wait(), SSE_KEEPALIVE_SECONDS)
+                    except asyncio.TimeoutError:
+                        yield None, None
+        finally:
+            with self.condition:
+                self.async_waiters.discard(waiter)
+
+class RemoteSyncJob:
+    """A sync job owned by another worker process, followed through its recorded events"""
+
+    def __init__(self, job_id, user_id):
+        self.id = job_id
+        self.user_id = user_id
+
+    def poll(self, index):
+        """Return (events from index on, state) where state is 'running', 'finished' or 'dead'"""
+        conn = get_coordination_db()
+        row = conn.execute('SELECT heartbeat, finished_at FROM sync_jobs WHERE job_id = ?', (self.id,)).fetchone()
+        # Events are recorded before the lease is released, so read them after the state
+        events = read_sync_events(self.id, index)
+        if row is None or row[1] is not None:
+            return events, 'finished'
+        return events, 'dead' if row[0] < time.time() - SYNC_LEASE_SECONDS else 'running'
+
+    def follow(self, index, idle_since, events, state):
+        """Turn one poll(index) result into stream items, for stream and stream_async.
+
+        Returns (items, next index, idle_since, ended).
+        """
+        items = list(events)
+        now = time.time()
+        if events:
+            index = events[-1][0] + 1
+            idle_since = now
+        if state == 'finished':
+            return items, index, idle_since, True
+        if state == 'dead' and not events:
+            items.append((index, {'type': 'error', 'message': 'The sync was interrupted. Please try again.'}))
+            return items, index, idle_since, True
+        if now - idle_since >= SSE_KEEPALIVE_SECONDS:
+            idle_since = now
+            items.append((None, None))
+        return items, index, idle_since, False
+
+    def stream(self, start=0):
+        """Yield (index, event) like SyncJob.stream, polling the coordination database"""
+        index, idle_since = start, time.time()
+        while True:
+            items, index, idle_since, ended = self.follow(index, idle_since, *self.poll(index))
+            yield from items
+            if ended:
+                return
+            time.sleep(SYNC_EVENT_POLL_SECONDS)
+
+    async def stream_async(self, start=0):
+        """Asyncio counterpart of stream"""
+        index, idle_since = start, time.time()
+        while True:
+            events, state = await asyncio.to_thread(self.poll, index)
+            items, index, idle_since, ended = self.follow(index, idle_since, events, state)
+            for item in items:
+                yield item
+            if ended:
+                return
+            await asyncio.sleep(SYNC_EVENT_POLL_SECONDS)
+
+_sync_jobs = {}
+_sync_jobs_lock = threading.Lock()
+
+# Event loop running the syncs of the 'asyncio' engine when the app is served
+# by a WSGI server; under asgi.py syncs run on the server's own loop instead
+_sync_loop = None
+_sync_loop_lock = threading.Lock()
+
+def get_sync_loop():
+    """Return the process's background sync event loop, starting it on first use"""
+    global _sync_loop
+    with _sync_loop_lock:
+        if _sync_loop is None:
+            _sync_loop = asyncio.new_event_loop()
+            threading.Thread(target=_sync_loop.run_forever, name='sync-loop', daemon=True).start()
+        return _sync_loop
+
+def get_or_start_sync_job(sp, user_id, job_id=None, loop=None):
+    """Return the user's running sync job (or the finished job_id), starting a new job if there is none.
+
+    A sync running in another worker process is followed as a RemoteSyncJob
+    instead of being started a second time. With the asyncio engine new jobs
+    run on loop, or on the background sync loop.
+    """
+    with _sync_jobs_lock:
+        now = time.time()
+        for other_user_id, other_job in list(_sync_jobs.items()):
+            if other_job.done and now - other_job.finished_at > SYNC_JOB_RETENTION_SECONDS:
+                del _sync_jobs[other_user_id]
+        job = _sync_jobs.get(user_id)
+        if job and (not job.done or job.id == job_id):
+            return job
+        if job_id and find_sync_job(job_id, user_id):
+            return RemoteSyncJob(job_id, user_id)
+        job_id, owned = acquire_sync_lease(user_id)
+        if not owned:
+            return RemoteSyncJob(job_id, user_id)
+        job = SyncJob(user_id, job_id)
+        _sync_jobs[user_id] = job
+    if SYNC_ENGINE == 'asyncio':
+        asyncio.run_coroutine_threadsafe(job.run_async(AsyncSpotify(sp.auth_manager)), loop or get_sync_loop())
+    else:
+        threading.Thread(target=job.run, args=(sp,), name=f'sync-{job.id}', daemon=True).start()
+    return job
+
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache, no-store, must-revalidate, no-transform',
+    'Connection': 'keep-alive',
+    'X-Accel-Buffering': 'no',
+    'Content-Type': 'text/event-stream; charset=utf-8'
+}
+
+def attach_sync_job(loop=None):
+    """Find or start the session user's sync job for /sync_library.
+
+    Returns (job, start_index, None), or (None, None, error_response) when
+    the session is not authenticated.
+    """
+    sp = get_spotify()
+    if not sp:
+        response = {
+            'success': False,
+            'error': 'Not authenticated.'
+        }
+        return None, None, app.response_class(
+            response=json.dumps(response),
+            status=401,
+            mimetype='application/json'
+        )
+    user_id = session.get('user_id')
+    if not user_id:
+        user_id = sp.current_user()['id']
+        session['user_id'] = user_id
+
+    job = get_or_start_sync_job(sp, user_id, request.args.get('job_id'), loop)
+    # Resume after the last event a reconnecting EventSource has seen
+    last_event_id = request.headers.get('Last-Event-ID', '')
+    start = int(last_event_id) + 1 if last_event_id.isdigit() else 0
+    return job, start, None
+
 @app.route('/sync_library', methods=['GET', 'OPTIONS'])
 def sync_library():
     if request.method == 'OPTIONS':
@@ -382,243 +3129,372 @@ def sync_library():
         )
         return response
     try:
-        sp = get_spotify()
-        if not sp:
-            response = {
-                'success': False,
-                'error': 'Not authenticated.'
-            }
-            return app.response_class(
-                response=json.dumps(response),
-                status=401,
-                mimetype='application/json'
-            )
-        try:
-            playlists = []
-            track_playlist_map = {}
-            # Now load 22 playlists, with pagination (10 per page)
-            results = sp.current_user_playlists(limit=PLAYLIST_PAGE_SIZE)
-            total_to_process = min(22, results['total'])
-            total_batches = (total_to_process + PLAYLIST_PAGE_SIZE - 1) // PLAYLIST_PAGE_SIZE
-            current_batch = 1
-            processed = 0
-            def format_sse(data):
-                try:
-                    if isinstance(data, dict):
-                        if 'progress' in data:
-                            progress = data['progress']
-                            data = {
-                                'type': 'progress',
-                                'data': {
-                                    'current': int(progress.get('current', 0)),
-                                    'total': int(progress.get('total', 0)),
-                                    'playlist': str(progress.get('playlist', ''))
-                                }
-                            }
-                        elif 'success' in data:
-                            data = {
-                                'type': 'complete',
-                                'data': {
-                                    'success': bool(data.get('success')),
-                                    'error': str(data.get('error', '')),
-                                    'playlists': data.get('playlists', []),
-                                    'last_sync': int(data.get('last_sync', 0))
-                                }
-                            }
-                    json_str = json.dumps(data, default=str)
-                    return f"data: {json_str}\n\n"
-                except Exception as e:
-                    print(f"Error formatting SSE data: {str(e)}")
-                    return f"data: {{\"type\":\"error\",\"message\":\"Internal server error\"}}\n\n"
-            def generate():
-                nonlocal current_batch, processed, playlists, results
-                try:
-                    yield format_sse({
-                        'progress': {
-                            'current': current_batch,
-                            'total': total_batches,
-                            'playlist': 'Starting...'
-                        }
-                    })
-                    sys.stdout.flush()
-                    while results and processed < total_to_process:
-                        batch_size = min(len(results['items']), total_to_process - processed)
-                        items_to_process = results['items'][:batch_size]
-                        processed += batch_size
-                        for item in items_to_process:
-                            try:
-                                full_playlist = sp.playlist(item['id'])
-                                playlist_tracks = []
-                                tracks_results = sp.playlist_tracks(item['id'])
-                                while tracks_results:
-                                    for track_item in tracks_results['items']:
-                                        if track_item['track']:
-                                            track = track_item['track']
-                                            playlist_tracks.append(track)
-                                            if track['id'] not in track_playlist_map:
-                                                track_playlist_map[track['id']] = []
-                                            track_playlist_map[track['id']].append({
-                                                'id': item['id'],
-                                                'name': item['name']
-                                            })
-                                    if not tracks_results['next']:
-                                        break
-                                    tracks_results = sp.next(tracks_results)
-                                optimized_playlist = optimize_playlist_data(full_playlist, playlist_tracks, track_playlist_map)
-                                playlists.append(optimized_playlist)
-                                yield format_sse({
-                                    'progress': {
-                                        'current': current_batch,
-                                        'total': total_batches,
-                                        'playlist': item['name']
-                                    }
-                                })
-                                sys.stdout.flush()
-                            except Exception as e:
-                                print(f"Error processing playlist {item['name']}: {str(e)}")
-                                continue
-                        user_id = session.get('user_id')
-                        if user_id:
-                            batch_data = {
-                                'playlists': playlists,
-                                'last_sync': int(time.time())
-                            }
-                            save_user_data(user_id, batch_data)
-                        # Go to next batch if needed
-                        if processed < total_to_process and results['next']:
-                            results = sp.next(results)
-                            current_batch += 1
-                            yield format_sse({
-                                'progress': {
-                                    'current': current_batch,
-                                    'total': total_batches
-                                }
-                            })
-                            sys.stdout.flush()
-                        else:
-                            break
-                    data = {
-                        'playlists': playlists,
-                        'last_sync': int(time.time())
-                    }
-                    user_id = session.get('user_id')
-                    if user_id:
-                        try:
-                            save_user_data(user_id, data)
-                        except Exception as e:
-                            print(f"Error saving data: {str(e)}")
-                            yield format_sse({
-                                'success': False,
-                                'error': 'Failed to save data'
-                            })
-                            sys.stdout.flush()
-                            return
-                    # FINAL SSE message
-                    yield format_sse({
-                        'success': True,
-                        'playlists': playlists,
-                        'last_sync': data['last_sync']
-                    })
-                    sys.stdout.flush()
-                except Exception as e:
-                    print(f"Exception in SSE generator: {str(e)}")
-                    yield format_sse({'type': 'error', 'message': str(e)})
-                    sys.stdout.flush()
-            try:
-                response = Response(
-                    stream_with_context(generate()),
-                    mimetype='text/event-stream',
-                    headers={
-                        'Cache-Control': 'no-cache, no-store, must-revalidate, no-transform',
-                        'Connection': 'keep-alive',
-                        'X-Accel-Buffering': 'no',
-                        'Content-Type': 'text/event-stream; charset=utf-8'
-                    }
-                )
-                response.timeout = None
-                return response
-            except Exception as e:
-                print(f"Error in SSE generator: {str(e)}")
-                return app.response_class(
-                    response=json.dumps({'success': False, 'error': 'Failed to sync playlists. Please try again.'}),
-                    status=500,
-                    mimetype='application/json'
-                )
-        except Exception as e:
-            print(f"Error in playlist sync: {str(e)}")
-            return app.response_class(
-                response=json.dumps({'success': False, 'error': 'Failed to sync playlists. Please try again.'}),
-                status=500,
-                mimetype='application/json'
-            )
+        job, start, error_response = attach_sync_job()
+        if error_response:
+            return error_response
+
+        def generate():
+            yield format_sse({'type': 'job', 'data': {'job_id': job.id}})
+            for index, event in job.stream(start):
+                if event is None:
+                    yield ": keep-alive\n\n"
+                else:
+                    yield format_sse(event, event_id=index)
+
+        response = Response(
+            stream_with_context(generate()),
+            mimetype='text/event-stream',
+            headers=SSE_HEADERS
+        )
+        response.timeout = None
+        return response
     except Exception as e:
-        print(f"Error in sync_library: {str(e)}")
+        logger.error("Error in sync_library: %s", e)
         return app.response_class(
             response=json.dumps({'success': False, 'error': 'An unexpected error occurred. Please try again.'}),
             status=500,
             mimetype='application/json'
         )
 
+# Cursor pagination for the library endpoints. Every list endpoint accepts
+# `cursor` (opaque, from the previous page's next_cursor), `limit`, `q`
+# (case-insensitive substring filter), `sort` (a key below, '-' prefix for
+# descending) and `fields` (comma separated top-level fields to return).
+PLAYLIST_SORT_KEYS = {
+    'position': None,
+    'name': lambda p: playlist_full_name(p).lower(),
+    'tracks': lambda p: p.get('tracks_total', 0),
+    'duration': lambda p: p.get('duration_ms', 0),
+}
+TRACK_SORT_KEYS = {
+    'position': None,
+    'name': lambda t: (t.get('name') or '').lower(),
+    'artist': lambda t: ', '.join(a['name'] for a in t.get('artists') or []).lower(),
+    'album': lambda t: ((t.get('album') or {}).get('name') or '').lower(),
+    'year': lambda t: ((t.get('album') or {}).get('release_date') or '')[:4],
+    'duration': lambda t: t.get('duration_ms') or 0,
+}
+
+def encode_cursor(offset):
+    return base64.urlsafe_b64encode(f'o:{offset}'.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        prefix, offset = base64.urlsafe_b64decode(padded).decode().split(':', 1)
+        if prefix != 'o' or int(offset) < 0:
+            raise ValueError
+        return int(offset)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError('invalid_cursor')
+
+def parse_page_args(sort_keys, default_limit):
+    """Read the pagination query parameters, raising ValueError for invalid ones"""
+    cursor = request.args.get('cursor')
+    stream = request.args.get('stream')
+    if stream not in (None, 'json', 'ndjson'):
+        raise ValueError('invalid_stream')
+    # Streamed responses are unbounded unless a limit is given
+    try:
+        limit = request.args.get('limit', None if stream else default_limit)
+        limit = int(limit) if limit is not None else None
+    except ValueError:
+        raise ValueError('invalid_limit')
+    if limit is not None and (limit < 1 or (not stream and limit > MAX_PAGE_SIZE)):
+        raise ValueError('invalid_limit')
+    sort = request.args.get('sort', 'position')
+    if sort.lstrip('-') not in sort_keys:
+        raise ValueError('invalid_sort')
+    fields = [f for f in request.args.get('fields', '').split(',') if f]
+    return {
+        'offset': decode_cursor(cursor) if cursor else 0,
+        'limit': limit,
+        'q': request.args.get('q', '').strip().lower(),
+        'sort': sort,
+        'fields': fields,
+        'stream': stream
+    }
+
+def filter_and_sort(items, page_args, matches, sort_keys):
+    """Lazily filter items; sorting has to materialize the matching ones"""
+    if page_args['q']:
+        items = (item for item in items if matches(item, page_args['q']))
+    sort_key = sort_keys[page_args['sort'].lstrip('-')]
+    if sort_key:
+        items = sorted(items, key=sort_key, reverse=page_args['sort'].startswith('-'))
+    elif page_args['sort'].startswith('-'):
+        items = list(items)[::-1]
+    return items
+
+def project_fields(item, fields):
+    return {k: item[k] for k in fields if k in item} if fields else item
+
+def paginate(items, page_args, matches, sort_keys):
+    """Filter, sort and slice items; returns (page, next_cursor, total_matching)"""
+    items = list(filter_and_sort(items, page_args, matches, sort_keys))
+    start = page_args['offset']
+    end = start + page_args['limit']
+    page = [project_fields(item, page_args['fields']) for item in items[start:end]]
+    return page, encode_cursor(end) if end < len(items) else None, len(items)
+
+def iter_page(items, page_args, matches, sort_keys, render=None):
+    """Lazily filter, sort, slice, render and project items for a streamed response.
+
+    Peeks one item past the page, and returns the next page's cursor, or None
+    when the page reaches the end of the items.
+    """
+    items = filter_and_sort(items, page_args, matches, sort_keys)
+    start = page_args['offset']
+    end = start + page_args['limit'] if page_args['limit'] is not None else None
+    for index, item in enumerate(islice(items, start, end + 1 if end is not None else None), start):
+        if index == end:
+            return encode_cursor(end)
+        yield project_fields(render(item) if render else item, page_args['fields'])
+    return None
+
+# Streamed responses are encoded item by item and flushed in chunks of about
+# STREAM_CHUNK_BYTES, so memory per request does not grow with the library.
+# 'json' produces the paginated endpoint's document without 'total', which
+# would need every matching item, and writes 'next_cursor' after the items;
+# 'ndjson' writes the envelope on the first line, one item per line after it
+# and {"next_cursor": ...} on the last line, null unless the page was cut off
+# by its limit.
+STREAM_CHUNK_BYTES = 64 * 1024
+
+def stream_items(envelope, key, items, stream_format):
+    """Return a streaming Response encoding envelope plus the items under key.
+
+    items may be an iter_page generator, whose return value is the next cursor.
+    """
+    page = {'next_cursor': None}
+
+    def consume():
+        page['next_cursor'] = yield from items
+
+    def encode():
+        if stream_format == 'ndjson':
+            yield json.dumps(envelope) + '\n'
+            for item in consume():
+                yield json.dumps(item) + '\n'
+            yield json.dumps(page) + '\n'
+            return
+        yield json.dumps(envelope)[:-1] + f', {json.dumps(key)}: ['
+        first = True
+        for item in consume():
+            yield ('' if first else ', ') + json.dumps(item)
+            first = False
+        yield f'], "next_cursor": {json.dumps(page["next_cursor"])}}}'
+
+    def generate():
+        buffer, size = [], 0
+        try:
+            for part in encode():
+                buffer.append(part)
+                size += len(part)
+                if size >= STREAM_CHUNK_BYTES:
+                    yield ''.join(buffer)
+                    buffer, size = [], 0
+        except Exception as e:
+            # Headers are already sent; a truncated document signals the failure
+            logger.error("Error streaming %s: %s", key, e)
+            if stream_format == 'ndjson':
+                buffer.append(json.dumps({'success': False, 'error': str(e)}) + '\n')
+        if buffer:
+            yield ''.join(buffer)
+
+    mimetype = 'application/x-ndjson' if stream_format == 'ndjson' else 'application/json'
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+def playlist_matches(playlist, q):
+    return q in playlist_full_name(playlist).lower()
+
+def track_matches(track, q):
+    album = track.get('album') or {}
+    values = [
+        track.get('name') or '',
+        ' '.join(a['name'] for a in track.get('artists') or []),
+        album.get('name') or '',
+        (album.get('release_date') or '')[:4]
+    ]
+    return any(q in value.lower() for value in values)
+
 @app.route('/playlist/<playlist_id>')
 def get_playlist(playlist_id):
     try:
-        # Load data from JSON
-        data_dir = DATA_DIR
-        json_files = [f for f in os.listdir(data_dir) if f.endswith('.json')]
-        
-        if not json_files:
-            return jsonify({'success': False, 'error': 'no_data'})
+        # Load the session user's library
+        user_id = session.get('user_id')
+        if not user_id:
+            return jsonify({'success': False, 'error': 'not_authenticated'}), 401
             
-        with open(os.path.join(data_dir, json_files[0]), 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        try:
+            page_args = parse_page_args(TRACK_SORT_KEYS, TRACK_PAGE_SIZE)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+        validators = library_validators(user_id)
+        cached = not_modified(validators)
+        if cached:
+            return cached
             
-        # Find the playlist in optimized data
-        playlist = next((p for p in data['playlists'] if p['id'] == playlist_id), None)
-        if not playlist:
+        # Find the playlist and resolve its tracks through the store's index
+        found = get_user_playlist(user_id, playlist_id, lazy=bool(page_args['stream']))
+        if not found:
+            return jsonify({'success': False, 'error': 'playlist_not_found'})
+        summary, tracks = found
+        if page_args['stream']:
+            return cacheable(stream_items({'success': True, 'playlist': summary}, 'tracks',
+                                          iter_page(tracks, page_args, track_matches, TRACK_SORT_KEYS),
+                                          page_args['stream']), validators)
+        page, next_cursor, total = paginate(tracks, page_args, track_matches, TRACK_SORT_KEYS)
+        return cacheable(jsonify({
+            'success': True,
+            'playlist': summary,
+            'tracks': page,
+            'total': total,
+            'next_cursor': next_cursor
+        }), validators)
+        
+    except Exception as e:
+        logger.error("Error getting playlist: %s", e)
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/playlist/<playlist_id>/overlap')
+def get_playlist_overlap(playlist_id):
+    """List the playlists sharing tracks with a playlist, most shared first"""
+    try:
+        user_id = session.get('user_id')
+        if not user_id:
+            return jsonify({'success': False, 'error': 'not_authenticated'}), 401
+        validators = library_validators(user_id)
+        cached = not_modified(validators)
+        if cached:
+            return cached
+        if not validators:
+            return jsonify({'success': False, 'error': 'no_data'})
+        overlap = get_user_playlist_overlap(user_id, playlist_id)
+        if overlap is None:
             return jsonify({'success': False, 'error': 'playlist_not_found'})
             
-        # The tracks are now included in the playlist object itself
-        return jsonify({
+        return cacheable(jsonify({
             'success': True,
-            'playlist': playlist,
-            'tracks': playlist['tracks']  # Get tracks directly from the playlist object
-        })
+            'overlap': overlap
+        }), validators)
         
     except Exception as e:
-        print(f"Error getting playlist: {str(e)}")
+        logger.error("Error getting playlist overlap: %s", e)
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/playlists')
 def get_playlists():
     try:
-        # Load data from JSON
-        data_dir = DATA_DIR
-        json_files = [f for f in os.listdir(data_dir) if f.endswith('.json')]
-        
-        if not json_files:
-            return jsonify({'success': False, 'error': 'no_data'})
+        # Load the session user's library
+        user_id = session.get('user_id')
+        if not user_id:
+            return jsonify({'success': False, 'error': 'not_authenticated'}), 401
             
-        with open(os.path.join(data_dir, json_files[0]), 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        try:
+            page_args = parse_page_args(PLAYLIST_SORT_KEYS, PLAYLIST_PAGE_SIZE)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+        validators = library_validators(user_id)
+        cached = not_modified(validators)
+        if cached:
+            return cached
             
-        # Get page size from environment variable
-        page_size = PLAYLIST_PAGE_SIZE
+        found = get_user_playlists(user_id)
+        if not found:
+            return jsonify({'success': False, 'error': 'no_data'})
+        summaries, last_sync = found
+        
+        if page_args['stream']:
+            envelope = {'success': True, 'last_sync': last_sync, 'page_size': page_args['limit']}
+            playlists = iter_page(summaries, page_args, playlist_matches, PLAYLIST_SORT_KEYS)
+            return cacheable(stream_items(envelope, 'playlists', playlists, page_args['stream']), validators)
+        page, next_cursor, total = paginate(summaries, page_args, playlist_matches, PLAYLIST_SORT_KEYS)
+        return cacheable(jsonify({
+            'success': True,
+            'playlists': page,
+            'total': total,
+            'next_cursor': next_cursor,
+            'last_sync': last_sync,
+            'page_size': page_args['limit']
+        }), validators)
+        
+    except Exception as e:
+        logger.error("Error getting playlists: %s", e)
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/stats')
+def get_stats():
+    """Library-wide analytics for the session user, from the stats kept up to date at sync time"""
+    try:
+        user_id = session.get('user_id')
+        if not user_id:
+            return jsonify({'success': False, 'error': 'not_authenticated'}), 401
+        validators = library_validators(user_id)
+        cached = not_modified(validators)
+        if cached:
+            return cached
+        found = get_user_stats(user_id)
+        if not found:
+            return jsonify({'success': False, 'error': 'no_data'})
+        stats_view, last_sync = found
+        return cacheable(jsonify({
+            'success': True,
+            'stats': stats_view,
+            'last_sync': last_sync
+        }), validators)
+        
+    except Exception as e:
+        logger.error("Error getting stats: %s", e)
+        return jsonify({'success': False, 'error': str(e)})
+
+SEARCH_RESULT_LIMIT = 50
+
+@app.route('/search')
+def search():
+    """Search tracks, artists, albums, playlists and folders of the session user's library"""
+    try:
+        user_id = session.get('user_id')
+        if not user_id:
+            return jsonify({'success': False, 'error': 'not_authenticated'}), 401
+        try:
+            limit = int(request.args.get('limit', SEARCH_RESULT_LIMIT))
+        except ValueError:
+            return jsonify({'success': False, 'error': 'invalid_limit'}), 400
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            return jsonify({'success': False, 'error': 'invalid_limit'}), 400
+
+        validators = library_validators(user_id)
+        cached = not_modified(validators)
+        if cached:
+            return cached
             
-        return jsonify({
+        found = get_user_search(user_id, request.args.get('q', ''), limit)
+        if found is None:
+            return jsonify({'success': False, 'error': 'no_data'})
+        playlists, tracks = found
+
+        return cacheable(jsonify({
             'success': True,
-            'playlists': data['playlists'],
-            'last_sync': data.get('last_sync', 0),
-            'page_size': page_size
-        })
+            'playlists': playlists,
+            'tracks': tracks
+        }), validators)
         
     except Exception as e:
-        print(f"Error getting playlists: {str(e)}")
+        logger.error("Error searching library: %s", e)
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/metrics')
+def metrics():
+    """Metrics of this worker process in the Prometheus text format"""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/favicon.ico')
 def favicon():
     return send_from_directory(os.path.join(app.root_path, 'static'),
-                             'favicon.ico', mimetype='image/vnd.microsoft.icon')
+                             'favicon.ico', mimetype='image/vnd.microsoft.icon', max_age=24 * 3600)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,99 @@
+"""ASGI entry point for Yocrify.
+
+/sync_library is served natively on the event loop, so an open progress
+stream does not hold a worker thread; every other route goes through the
+Flask app. Run it with an ASGI server, for example:
+
+    SYNC_ENGINE=asyncio uvicorn asgi:application
+
+Requires the asgiref package, plus httpx for the asyncio sync engine.
+"""
+import asyncio
+
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.test import EnvironBuilder
+
+from app import app, attach_sync_job, close_async_http_client, format_sse, logger, SSE_HEADERS
+
+wsgi_application = WsgiToAsgi(app)
+
+def build_environ(scope):
+    """Build the WSGI environ of an ASGI HTTP request without a body"""
+    headers = [(name.decode('latin-1'), value.decode('latin-1')) for name, value in scope['headers']]
+    host = dict((name.lower(), value) for name, value in headers).get('host', 'localhost')
+    client = scope.get('client') or ('', 0)
+    return EnvironBuilder(
+        path=scope['path'],
+        base_url=f"{scope.get('scheme', 'http')}://{host}{scope.get('root_path', '')}",
+        query_string=scope['query_string'].decode('latin-1'),
+        method=scope['method'],
+        headers=headers,
+        environ_overrides={'REMOTE_ADDR': client[0]}
+    ).get_environ()
+
+async def send_response_start(send, response):
+    headers = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+               for name, value in response.headers.items() if name.lower() != 'content-length']
+    await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+
+async def sync_library(scope, receive, send):
+    """Stream a sync job's events like the Flask /sync_library route"""
+    loop = asyncio.get_running_loop()
+    with app.request_context(build_environ(scope)):
+        try:
+            # Token refresh and the sync lease block, so they run off the loop
+            job, start, response = await asyncio.to_thread(attach_sync_job, loop)
+        except Exception as e:
+            logger.error("Error in sync_library: %s", e)
+            job, response = None, app.response_class(
+                response='{"success": false, "error": "An unexpected error occurred. Please try again."}',
+                status=500,
+                mimetype='application/json'
+            )
+        if job is not None:
+            response = app.response_class(headers=SSE_HEADERS)
+        # Runs the after_request handlers and saves the session cookie
+        response = app.process_response(response)
+
+    await send_response_start(send, response)
+    if job is None:
+        await send({'type': 'http.response.body', 'body': response.get_data()})
+        return
+
+    disconnected = asyncio.Event()
+
+    async def watch_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set()
+
+    watcher = asyncio.create_task(watch_disconnect())
+    try:
+        await send({'type': 'http.response.body', 'more_body': True,
+                    'body': format_sse({'type': 'job', 'data': {'job_id': job.id}}).encode('utf-8')})
+        async for index, event in job.stream_async(start):
+            if disconnected.is_set():
+                return
+            chunk = ": keep-alive\n\n" if event is None else format_sse(event, event_id=index)
+            await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        watcher.cancel()
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close_async_http_client()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    elif scope['type'] == 'http' and scope['path'] == '/sync_library' and scope['method'] == 'GET':
+        await sync_library(scope, receive, send)
+    else:
+        await wsgi_application(scope, receive, send)
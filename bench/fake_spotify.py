@@ -0,0 +1,180 @@
+"""Local stand-in for the parts of the Spotify Web API that Yocrify uses.
+
+Serves a synthetic, deterministic library generated on the fly (nothing is
+held in memory per track), with configurable response latency and a share
+of 429 responses. GET /_stats returns request counters; POST /_reset
+clears them and bumps every playlist's snapshot_id.
+
+    python bench/fake_spotify.py --playlists 1000 --tracks 200000 --port 8901
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+class FakeLibrary:
+    """Synthetic library: playlist i holds a seeded random selection of the track pool"""
+
+    def __init__(self, playlists, tracks, user_id='bench-user', seed=1, max_playlist_tracks=None):
+        self.playlist_count = playlists
+        self.track_count = tracks
+        self.user_id = user_id
+        self.seed = seed
+        self.generation = 0
+        # Average playlist size such that the playlists cover the pool once over
+        average = max(1, tracks // max(1, playlists))
+        self.max_playlist_tracks = max_playlist_tracks or average * 2
+        sizes = random.Random(seed)
+        self.sizes = [sizes.randint(0, self.max_playlist_tracks) for _ in range(playlists)]
+
+    def track(self, index):
+        return {
+            'id': f't{index}',
+            'uri': f'spotify:track:t{index}',
+            'name': f'Track {index}',
+            'duration_ms': 120000 + index % 180000,
+            'artists': [{'id': f'a{index % 5000}', 'name': f'Artist {index % 5000}'}],
+            'album': {'id': f'al{index % 20000}', 'name': f'Album {index % 20000}',
+                      'release_date': f'{1960 + index % 64}-01-01'},
+        }
+
+    def playlist_track_indexes(self, index):
+        rnd = random.Random(self.seed * 1000003 + index)
+        return [rnd.randrange(self.track_count) for _ in range(self.sizes[index])]
+
+    def playlist_summary(self, index):
+        name = f'Folder {index % 20}_Playlist {index}' if index % 3 == 0 else f'Playlist {index}'
+        return {
+            'id': f'p{index}',
+            'name': name,
+            'description': '',
+            'images': [],
+            'snapshot_id': f's{index}-{self.generation}',
+            'owner': {'display_name': self.user_id, 'external_urls': {}, 'href': '', 'id': self.user_id,
+                      'type': 'user', 'uri': f'spotify:user:{self.user_id}'},
+            'tracks': {'total': self.sizes[index]},
+        }
+
+class FakeSpotifyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def page_url(self, path, offset, limit):
+        return f'http://{self.headers["Host"]}{path}?offset={offset}&limit={limit}'
+
+    def tracks_page(self, index, path, offset, limit):
+        library = self.server.library
+        track_indexes = library.playlist_track_indexes(index)
+        items = [{'track': library.track(t)} for t in track_indexes[offset:offset + limit]]
+        end = offset + limit
+        return {
+            'items': items,
+            'total': len(track_indexes),
+            'offset': offset,
+            'limit': limit,
+            'next': self.page_url(path, end, limit) if end < len(track_indexes) else None,
+        }
+
+    def do_POST(self):
+        if self.path == '/_reset':
+            with self.server.lock:
+                self.server.requests = 0
+                self.server.rate_limited = 0
+                self.server.library.generation += 1
+            return self.send_json(200, {'generation': self.server.library.generation})
+        self.send_json(404, {'error': {'status': 404, 'message': 'Not found'}})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path == '/_stats':
+            return self.send_json(200, {'requests': self.server.requests, 'rate_limited': self.server.rate_limited})
+
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            limited = server.rate_limit_share and server.random.random() < server.rate_limit_share
+            if limited:
+                server.rate_limited += 1
+        if server.latency:
+            time.sleep(server.latency)
+        if limited:
+            return self.send_json(429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}},
+                                  {'Retry-After': str(server.retry_after)})
+
+        library = server.library
+        parts = url.path.strip('/').split('/')
+        offset = int(query.get('offset', 0))
+        limit = int(query.get('limit', 100))
+        if parts[:2] == ['v1', 'me'] and len(parts) == 2:
+            return self.send_json(200, {'id': library.user_id, 'display_name': library.user_id})
+        if parts[:3] == ['v1', 'me', 'playlists']:
+            limit = min(limit, 50)
+            end = min(offset + limit, library.playlist_count)
+            return self.send_json(200, {
+                'items': [library.playlist_summary(i) for i in range(offset, end)],
+                'total': library.playlist_count,
+                'offset': offset,
+                'limit': limit,
+                'next': self.page_url(url.path, end, limit) if end < library.playlist_count else None,
+            })
+        if parts[:2] == ['v1', 'playlists'] and len(parts) in (3, 4):
+            try:
+                index = int(parts[2].lstrip('p'))
+                library.sizes[index]
+            except (ValueError, IndexError):
+                return self.send_json(404, {'error': {'status': 404, 'message': 'Not found'}})
+            if len(parts) == 4 and parts[3] == 'tracks':
+                return self.send_json(200, self.tracks_page(index, url.path, offset, min(limit, 100)))
+            playlist = library.playlist_summary(index)
+            playlist['tracks'] = self.tracks_page(index, f'{url.path}/tracks', 0, 100)
+            return self.send_json(200, playlist)
+        self.send_json(404, {'error': {'status': 404, 'message': 'Not found'}})
+
+def create_server(port=0, playlists=1000, tracks=200000, latency_ms=0, rate_limit_share=0.0,
+                  retry_after=1, seed=1):
+    """Create (but do not start) a fake Spotify server; port 0 picks a free port"""
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeSpotifyHandler)
+    server.daemon_threads = True
+    server.library = FakeLibrary(playlists, tracks, seed=seed)
+    server.latency = latency_ms / 1000
+    server.rate_limit_share = rate_limit_share
+    server.retry_after = retry_after
+    server.random = random.Random(seed)
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.rate_limited = 0
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8901)
+    parser.add_argument('--playlists', type=int, default=1000)
+    parser.add_argument('--tracks', type=int, default=200000)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--rate-limit-share', type=float, default=0.0, help='share of requests answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    server = create_server(args.port, args.playlists, args.tracks, args.latency_ms, args.rate_limit_share,
+                           args.retry_after, args.seed)
+    print(f'Fake Spotify API on http://127.0.0.1:{server.server_port}/v1/')
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""Benchmark harness: syncs a synthetic library from a local fake Spotify API
+and measures route latency, writing the results as JSON.
+
+Measures:
+- /sync_library end-to-end time and API calls, for a cold and an unchanged resync
+- p50/p99 latency of /, /playlists and /playlist/<id>
+- peak RSS of the app process
+
+    python bench/run.py --playlists 1000 --tracks 200000 --output bench.json
+    python bench/run.py --baseline bench.json   # exit 1 on regressions
+
+The app runs in this process on a werkzeug server with its data in a
+temporary directory; the fake API runs in a subprocess.
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_USER = 'bench-user'
+RESULT_FORMAT = 1
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_fake_spotify(args):
+    """Start bench/fake_spotify.py in a subprocess and wait until it answers"""
+    port = free_port()
+    process = subprocess.Popen([
+        sys.executable, os.path.join(BENCH_DIR, 'fake_spotify.py'), '--port', str(port),
+        '--playlists', str(args.playlists), '--tracks', str(args.tracks),
+        '--latency-ms', str(args.latency_ms), '--rate-limit-share', str(args.rate_limit_share),
+        '--retry-after', str(args.retry_after), '--seed', str(args.seed),
+    ], stdout=subprocess.DEVNULL)
+    base_url = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            requests.get(f'{base_url}/_stats', timeout=1)
+            return process, base_url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('fake Spotify server did not start')
+
+def import_app(args, data_dir, spotify_url):
+    """Import app.py configured for the fake API; settings are read at import time"""
+    os.environ.update({
+        'DATA_DIR': data_dir,
+        'SPOTIFY_API_PREFIX': f'{spotify_url}/v1/',
+        'SPOTIFY_RATE_LIMIT': str(args.spotify_rate_limit),
+        'SYNC_ENGINE': args.engine,
+        'LOG_LEVEL': os.environ.get('LOG_LEVEL', 'WARNING'),
+        'STORAGE_BACKEND': args.storage,
+        'SPOTIFY_CLIENT_ID': os.environ.get('SPOTIFY_CLIENT_ID', 'bench'),
+        'SPOTIFY_CLIENT_SECRET': os.environ.get('SPOTIFY_CLIENT_SECRET', 'bench'),
+        'SPOTIFY_REDIRECT_URI': os.environ.get('SPOTIFY_REDIRECT_URI', 'http://127.0.0.1/callback'),
+    })
+    sys.path.insert(0, os.path.dirname(BENCH_DIR))
+    import app
+    return app
+
+def start_app(app):
+    """Serve the Flask app on a free port; returns its base URL and a session cookie for BENCH_USER"""
+    import logging
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    app.token_manager.save(BENCH_USER, {'access_token': 'bench', 'refresh_token': 'bench',
+                                        'token_type': 'Bearer', 'expires_at': int(time.time()) + 10 ** 6})
+    server = make_server('127.0.0.1', 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    cookie = app.app.session_interface.get_signing_serializer(app.app).dumps({'user_id': BENCH_USER})
+    return f'http://127.0.0.1:{server.server_port}', {app.app.config['SESSION_COOKIE_NAME']: cookie}
+
+def spotify_stats(spotify_url):
+    return requests.get(f'{spotify_url}/_stats', timeout=5).json()
+
+def measure_sync(app_url, cookies, spotify_url):
+    """Run one /sync_library to completion; returns its time, API calls and outcome"""
+    before = spotify_stats(spotify_url)
+    started = time.perf_counter()
+    outcome, events = None, 0
+    with requests.get(f'{app_url}/sync_library', cookies=cookies, stream=True, timeout=None) as response:
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith('data: '):
+                continue
+            events += 1
+            event = json.loads(line[len('data: '):])
+            if event.get('type') == 'complete':
+                outcome = 'success' if event['data'].get('success') else event['data'].get('error')
+                break
+            if event.get('type') == 'error':
+                outcome = event.get('message')
+                break
+    seconds = time.perf_counter() - started
+    after = spotify_stats(spotify_url)
+    return {
+        'seconds': round(seconds, 3),
+        'api_calls': after['requests'] - before['requests'],
+        'rate_limited': after['rate_limited'] - before['rate_limited'],
+        'events': events,
+        'outcome': outcome,
+    }
+
+def measure_route(http, url, cookies, count):
+    """Request url count times; returns latency percentiles in milliseconds"""
+    http.get(url, cookies=cookies)  # warm up caches
+    latencies = []
+    for _ in range(count):
+        started = time.perf_counter()
+        response = http.get(url, cookies=cookies)
+        response.content
+        latencies.append((time.perf_counter() - started) * 1000)
+    percentiles = statistics.quantiles(latencies, n=100, method='inclusive')
+    return {
+        'requests': count,
+        'p50_ms': round(statistics.median(latencies), 3),
+        'p99_ms': round(percentiles[98], 3),
+        'status': response.status_code,
+    }
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / 1024 / (1024 if sys.platform == 'darwin' else 1), 1)
+
+def run(args):
+    fake_process, spotify_url = start_fake_spotify(args)
+    try:
+        with tempfile.TemporaryDirectory(prefix='yocrify-bench-') as data_dir:
+            app = import_app(args, data_dir, spotify_url)
+            app_url, cookies = start_app(app)
+            results = {
+                'format': RESULT_FORMAT,
+                'timestamp': int(time.time()),
+                'config': {k: v for k, v in vars(args).items() if k not in ('output', 'baseline', 'tolerance')},
+                'sync': measure_sync(app_url, cookies, spotify_url),
+                'resync': measure_sync(app_url, cookies, spotify_url),
+            }
+            http = requests.Session()
+            playlists = http.get(f'{app_url}/playlists', params={'limit': 500, 'fields': 'id'},
+                                 cookies=cookies).json().get('playlists', [])
+            playlist_ids = [p['id'] for p in playlists] or ['missing']
+            rnd = random.Random(args.seed)
+            results['routes'] = {
+                '/': measure_route(http, f'{app_url}/', cookies, args.requests),
+                '/playlists': measure_route(http, f'{app_url}/playlists', cookies, args.requests),
+                '/playlist/<id>': measure_route(http, f'{app_url}/playlist/{rnd.choice(playlist_ids)}',
+                                                cookies, args.requests),
+            }
+            results['peak_rss_mb'] = peak_rss_mb()
+            return results
+    finally:
+        fake_process.kill()
+        fake_process.wait()
+
+def lower_is_better_metrics(results):
+    """Flatten the metrics where a larger value is a regression"""
+    metrics = {}
+    for phase in ('sync', 'resync'):
+        metrics[f'{phase}.seconds'] = results[phase]['seconds']
+        metrics[f'{phase}.api_calls'] = results[phase]['api_calls']
+    for route, timing in results['routes'].items():
+        metrics[f'routes.{route}.p50_ms'] = timing['p50_ms']
+        metrics[f'routes.{route}.p99_ms'] = timing['p99_ms']
+    if results.get('peak_rss_mb') is not None:
+        metrics['peak_rss_mb'] = results['peak_rss_mb']
+    return metrics
+
+def find_regressions(results, baseline, tolerance):
+    current = lower_is_better_metrics(results)
+    previous = lower_is_better_metrics(baseline)
+    return {name: {'baseline': previous[name], 'current': value}
+            for name, value in current.items()
+            if name in previous and value > previous[name] * (1 + tolerance)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--playlists', type=int, default=1000)
+    parser.add_argument('--tracks', type=int, default=200000)
+    parser.add_argument('--latency-ms', type=float, default=20, help='fake API latency per request')
+    parser.add_argument('--rate-limit-share', type=float, default=0.01, help='share of API requests answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--spotify-rate-limit', type=float, default=0,
+                        help="the app's own request rate limit (SPOTIFY_RATE_LIMIT, 0 disables it)")
+    parser.add_argument('--engine', choices=('threads', 'asyncio'), default='threads')
+    parser.add_argument('--storage', choices=('json', 'sqlite'), default='json')
+    parser.add_argument('--requests', type=int, default=200, help='requests per measured route')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    parser.add_argument('--baseline', help='previous results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against the baseline')
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            results['regressions'] = find_regressions(results, json.load(f), args.tolerance)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if results.get('regressions'):
+        print(f"Regressions against {args.baseline}: {', '.join(results['regressions'])}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Test fixtures: the app imported against a temporary data directory, and a
+local fake Spotify API (bench/fake_spotify.py) to sync libraries from.
+"""
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import uuid
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+DATA_DIR = tempfile.mkdtemp(prefix='yocrify-tests-')
+atexit.register(shutil.rmtree, DATA_DIR, ignore_errors=True)
+
+# Settings are read at import time
+os.environ.update({
+    'DATA_DIR': DATA_DIR,
+    'SPOTIFY_RATE_LIMIT': '0',
+    'SYNC_ENGINE': 'threads',
+    'LOG_LEVEL': os.environ.get('LOG_LEVEL', 'WARNING'),
+})
+
+import app as yocrify  # noqa: E402
+from fake_spotify import create_server  # noqa: E402
+
+@pytest.fixture
+def app():
+    return yocrify
+
+@pytest.fixture(params=['json', 'sqlite'])
+def storage(request, monkeypatch):
+    monkeypatch.setattr(yocrify, 'STORAGE_BACKEND', request.param)
+    return request.param
+
+@pytest.fixture
+def user_id():
+    """A user of their own per test, as every test shares the data directory"""
+    return f'user-{uuid.uuid4().hex[:12]}'
+
+@pytest.fixture
+def fake_spotify(monkeypatch):
+    """Return a factory starting a fake Spotify API; layout optionally lists each playlist's track indexes"""
+    servers = []
+
+    def start(playlists=3, tracks=10, layout=None):
+        server = create_server(playlists=playlists, tracks=tracks)
+        if layout is not None:
+            server.library.playlist_count = len(layout)
+            server.library.sizes = [len(indexes) for indexes in layout]
+            server.library.playlist_track_indexes = lambda index: layout[index]
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        monkeypatch.setattr(yocrify, 'SPOTIFY_API_PREFIX', f'http://127.0.0.1:{server.server_port}/v1/')
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def spotify_client():
+    return yocrify.RateLimitedSpotify(auth='test', requests_session=yocrify.spotify_http_session,
+                                      requests_timeout=yocrify.SPOTIFY_REQUEST_TIMEOUT)
+
+def run_sync(server, user_id, stop_after=None):
+    """Sync user_id's library from server; returns (last event, API requests made).
+
+    With stop_after the sync is abandoned after that many synced playlists,
+    like a worker killed mid-sync.
+    """
+    before = server.requests
+    events = yocrify.sync_user_library(spotify_client(), user_id)
+    synced = 0
+    event = None
+    for event in events:
+        if 'playlist' in event:
+            synced += 1
+            if synced == stop_after:
+                events.close()
+                break
+    return event, server.requests - before
+
+def get_json(user_id, path, **params):
+    """GET a route as user_id and return its JSON body"""
+    client = yocrify.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+    response = client.get(path, query_string=params)
+    assert response.status_code == 200, response.data
+    return response.get_json()
+
+def library_views(user_id):
+    """Return the /playlists listing and every /playlist/<id> and overlap response of a user"""
+    playlists = get_json(user_id, '/playlists', limit=yocrify.MAX_PAGE_SIZE)
+    views = {'playlists': playlists}
+    for playlist in playlists['playlists']:
+        views[playlist['id']] = get_json(user_id, f"/playlist/{playlist['id']}", limit=yocrify.MAX_PAGE_SIZE)
+        views[f"{playlist['id']}/overlap"] = get_json(user_id, f"/playlist/{playlist['id']}/overlap")
+    return views
@@ -0,0 +1,63 @@
+import json
+import os
+
+import pytest
+
+from conftest import get_json, library_views, run_sync
+
+# p0 holds track 1 twice, p3 holds track 5 twice and shares no track
+DUPLICATES_LAYOUT = [[1, 2, 1], [1, 3], [2, 4], [5, 5]]
+
+def ids(refs):
+    return [ref['id'] for ref in refs]
+
+def test_other_playlists_of_a_track_repeated_in_a_playlist(app, storage, fake_spotify, user_id):
+    run_sync(fake_spotify(layout=DUPLICATES_LAYOUT), user_id)
+
+    p0 = get_json(user_id, '/playlist/p0')
+    assert [track['id'] for track in p0['tracks']] == ['t1', 't2', 't1']
+    assert [ids(track['other_playlists']) for track in p0['tracks']] == [['p1'], ['p2'], ['p1']]
+    p1 = get_json(user_id, '/playlist/p1')
+    assert [ids(track['other_playlists']) for track in p1['tracks']] == [['p0'], []]
+    p3 = get_json(user_id, '/playlist/p3')
+    assert [ids(track['other_playlists']) for track in p3['tracks']] == [[], []]
+
+    playlists = get_json(user_id, '/playlists')['playlists']
+    assert {p['id']: p['duplicate_tracks'] for p in playlists} == {'p0': 3, 'p1': 1, 'p2': 1, 'p3': 0}
+    assert get_json(user_id, '/stats')['stats']['duplicate_tracks'] == 2
+
+def test_overlap_counts_a_repeated_track_once(app, storage, fake_spotify, user_id):
+    run_sync(fake_spotify(layout=DUPLICATES_LAYOUT), user_id)
+
+    overlap = get_json(user_id, '/playlist/p0/overlap')['overlap']
+    assert sorted((entry['id'], entry['shared_tracks']) for entry in overlap) == [('p1', 1), ('p2', 1)]
+    overlap = get_json(user_id, '/playlist/p1/overlap')['overlap']
+    assert [(entry['id'], entry['shared_tracks']) for entry in overlap] == [('p0', 1)]
+    assert get_json(user_id, '/playlist/p3/overlap')['overlap'] == []
+
+    tracks = get_json(user_id, '/search', q='Track 1')['tracks']
+    assert sorted(ids(tracks[0]['playlists'])) == ['p0', 'p1']
+
+def legacy_library(library, embedded):
+    """Write a library back in a JSON layout of earlier versions"""
+    data = library['data']
+    if not embedded:
+        return {'last_sync': data['last_sync'], 'playlists': data['playlists'], 'tracks': data['tracks']}
+    playlists = [{**{k: v for k, v in playlist.items() if k != 'track_ids'},
+                  'tracks': [data['tracks'][key] for key in playlist['track_ids']]}
+                 for playlist in data['playlists']]
+    return {'last_sync': data['last_sync'], 'playlists': playlists}
+
+@pytest.mark.parametrize('embedded', [True, False], ids=['embedded-tracks', 'track-table'])
+def test_legacy_json_library_is_converted(app, monkeypatch, fake_spotify, user_id, embedded):
+    monkeypatch.setattr(app, 'STORAGE_BACKEND', 'json')
+    synced_user = f'{user_id}-synced'
+    run_sync(fake_spotify(layout=DUPLICATES_LAYOUT), synced_user)
+    before = library_views(synced_user)
+
+    legacy_path = app.legacy_data_path(user_id)
+    with open(legacy_path, 'w', encoding='utf-8') as f:
+        json.dump(legacy_library(app.get_user_library(synced_user), embedded), f)
+    assert library_views(user_id) == before
+    assert not os.path.exists(legacy_path)
+    assert os.path.exists(app.user_data_path(user_id))
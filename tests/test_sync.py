@@ -0,0 +1,123 @@
+import os
+
+import pytest
+
+from conftest import get_json, library_views, run_sync
+
+def change_playlists(server, *indexes):
+    """Give playlists of a fake library new snapshot ids, leaving the others unchanged"""
+    library = server.library
+    versions = getattr(library, 'versions', None)
+    if versions is None:
+        versions = library.versions = {}
+        summary = library.playlist_summary
+        library.playlist_summary = lambda index: {**summary(index),
+                                                  'snapshot_id': f's{index}-v{versions.get(index, 0)}'}
+    for index in indexes:
+        versions[index] = versions.get(index, 0) + 1
+
+def same_library(views):
+    """Normalize library_views for comparing two syncs of a library.
+
+    Playlists are stored in the order their fetches complete, so positions
+    (and the order of playlists sharing a track) differ between syncs.
+    """
+    by_id = lambda entry: entry['id']
+    normalized = {'playlists': sorted(views.pop('playlists')['playlists'], key=by_id)}
+    for name, view in views.items():
+        if name.endswith('/overlap'):
+            normalized[name] = sorted(view['overlap'], key=by_id)
+        else:
+            normalized[name] = (view['playlist'], [{**track, 'other_playlists': sorted(track['other_playlists'], key=by_id)}
+                                                   for track in view['tracks']])
+    return normalized
+
+def same_stats(body):
+    """Normalize a /stats body like same_library; ties in the top lists are ranked by position"""
+    stats = body['stats']
+    for name in ('most_shared_tracks', 'top_overlap'):
+        stats[name] = sorted(stats[name], key=repr)
+    return stats
+
+def test_interrupted_sync_resumes_from_checkpoint(app, storage, fake_spotify, user_id):
+    server = fake_spotify(playlists=120, tracks=2000)
+    reference_user = f'{user_id}-reference'
+    event, full_calls = run_sync(server, reference_user)
+    assert event['success']
+
+    # Abandoned after the first listing page of 50 playlists was checkpointed
+    event, _ = run_sync(server, user_id, stop_after=60)
+    assert 'success' not in event
+    assert get_json(user_id, '/playlists') == {'success': False, 'error': 'no_data'}
+
+    event, resumed_calls = run_sync(server, user_id)
+    assert event['success']
+    assert resumed_calls <= full_calls - 50
+    assert same_library(library_views(user_id)) == same_library(library_views(reference_user))
+    if storage == 'json':
+        assert not os.path.exists(app.sync_checkpoint_path(user_id))
+
+def test_truncated_checkpoint_line_is_dropped(app, monkeypatch, fake_spotify, user_id):
+    monkeypatch.setattr(app, 'STORAGE_BACKEND', 'json')
+    server = fake_spotify(playlists=120, tracks=2000)
+    reference_user = f'{user_id}-reference'
+    run_sync(server, reference_user)
+
+    run_sync(server, user_id, stop_after=60)
+    checkpoint_path = app.sync_checkpoint_path(user_id)
+    with open(checkpoint_path, 'rb') as f:
+        records = f.read().count(b'\n')
+    # A write cut short by a crash
+    with open(checkpoint_path, 'ab') as f:
+        f.write(b'{"playlist": {"id": "p119", "name": "Play')
+    assert len(app.index_sync_checkpoint(user_id)) == records
+    with open(checkpoint_path, 'rb') as f:
+        assert f.read().endswith(b'\n')
+
+    event, _ = run_sync(server, user_id)
+    assert event['success']
+    assert same_library(library_views(user_id)) == same_library(library_views(reference_user))
+    assert not os.path.exists(checkpoint_path)
+
+def test_resync_updates_stats_like_a_fresh_sync(app, storage, fake_spotify, user_id):
+    layout = [[1, 2, 1], [1, 3], [2, 4], [5, 5, 6]]
+    server = fake_spotify(layout=layout)
+    run_sync(server, user_id)
+
+    # Change two playlists, one of them gaining a repeated track, and drop the last one
+    layout[0][:] = [1, 1, 4]
+    layout[2][:] = [6, 3, 3]
+    change_playlists(server, 0, 2)
+    layout.pop()
+    server.library.playlist_count = len(layout)
+    event, _ = run_sync(server, user_id)
+    assert event['success']
+
+    reference_user = f'{user_id}-reference'
+    run_sync(server, reference_user)
+    assert same_stats(get_json(user_id, '/stats')) == same_stats(get_json(reference_user, '/stats'))
+
+@pytest.mark.parametrize('stored', [True, False])
+def test_playlist_failing_to_fetch(app, storage, monkeypatch, fake_spotify, user_id, stored):
+    monkeypatch.setattr(app, 'SPOTIFY_BACKOFF_CAP', 0)
+    layout = [[1, 2], [2, 3]]
+    server = fake_spotify(layout=layout)
+    if stored:
+        run_sync(server, user_id)
+        before = get_json(user_id, '/playlist/p1')
+    change_playlists(server, 1)
+
+    def playlist_track_indexes(index):
+        if index == 1:
+            raise LookupError('p1 is unavailable')  # The fake API drops the connection
+        return layout[index]
+
+    server.library.playlist_track_indexes = playlist_track_indexes
+    event, _ = run_sync(server, user_id)
+    assert event['success']
+    playlists = sorted(p['id'] for p in get_json(user_id, '/playlists')['playlists'])
+    if stored:
+        assert playlists == ['p0', 'p1']
+        assert get_json(user_id, '/playlist/p1') == before
+    else:
+        assert playlists == ['p0']